@@ -0,0 +1,80 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+import os
+import threading
+import time
+
+def call_site(frame):
+    code = frame.f_code
+    return "%s:%d:%s" % (os.path.basename(code.co_filename), frame.f_lineno,
+                         code.co_name)
+
+def fingerprint(exc_info, caller):
+    """Return the fingerprint of an alert reported from the frame
+    caller. If exc_info is the sys.exc_info() of an exception, the
+    fingerprint includes the exception's type and the call site where
+    it was raised."""
+    if exc_info and exc_info[0]:
+        traceback = exc_info[2]
+        while traceback.tb_next:
+            traceback = traceback.tb_next
+        code = traceback.tb_frame.f_code
+        raised = "%s:%d:%s" % (os.path.basename(code.co_filename),
+                               traceback.tb_lineno, code.co_name)
+        return "%s at %s from %s" % (exc_info[0].__name__, raised,
+                                     call_site(caller))
+    return "error from %s" % call_site(caller)
+
+class AlertThrottle(object):
+    """Count the occurrences of each alert fingerprint within a window
+    of window seconds which starts with its first occurrence.
+
+    Only the first occurrence of an alert should be sent. The repeats
+    are counted and reported by summaries once the window ends, after
+    which a new window starts. An alert which did not repeat during its
+    window is forgotten, so that its next occurrence is sent again.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.alerts = {}
+
+    def record(self, alert_fingerprint, subject):
+        """Record an occurrence of the alert and return True if it is
+        the first occurrence in the alert's window."""
+        now = time.time()
+        with self.lock:
+            alert = self.alerts.get(alert_fingerprint)
+            if alert and now - alert["start"] < self.window:
+                alert["count"] += 1
+                alert["last"] = now
+                alert["subject"] = subject
+                return False
+            self.alerts[alert_fingerprint] = {"start": now,
+                                              "count": 0,
+                                              "last": now,
+                                              "subject": subject}
+            return True
+
+    def summaries(self, force=False):
+        """Return a list of (fingerprint, subject, count, last) tuples
+        of the alerts which repeated during windows which have ended,
+        or during any window if force is True, and start their next
+        windows."""
+        now = time.time()
+        summaries = []
+        with self.lock:
+            for alert_fingerprint, alert in self.alerts.items():
+                if not force and now - alert["start"] < self.window:
+                    continue
+                if alert["count"]:
+                    summaries.append((alert_fingerprint, alert["subject"],
+                                      alert["count"], alert["last"]))
+                    alert["start"] = now
+                    alert["count"] = 0
+                else:
+                    del self.alerts[alert_fingerprint]
+        summaries.sort()
+        return summaries
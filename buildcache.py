@@ -0,0 +1,157 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+import errno
+import json
+import os
+import shutil
+import threading
+import time
+
+from httppool import file_digests
+
+def link_or_copy(source, destination):
+    """Hard link source to destination, copying it if the two are
+    on different file systems."""
+    if os.path.exists(destination):
+        os.unlink(destination)
+    try:
+        os.link(source, destination)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(source, destination)
+
+class BuildCache(object):
+    """An on disk least recently used cache of build installers and
+    their build information.
+
+    Each installer is stored once as <sha1>.exe in cachedir. A build
+    is looked up by its url together with the ETag and Last-Modified
+    headers the server reported for it, so a url whose contents have
+    changed such as a nightly build is not mistaken for the cached
+    build. A url without either header cannot be told apart from a
+    changed build and is never cached. The index of urls and builds is
+    kept in index.json. When
+    the installers exceed max_bytes, the least recently used are
+    evicted.
+    """
+    def __init__(self, cachedir, max_bytes, logger):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.index_path = os.path.join(cachedir, "index.json")
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.index = {"keys": {}, "builds": {}}
+        if os.path.exists(self.index_path):
+            try:
+                self.index = json.load(open(self.index_path))
+            except ValueError:
+                self.logger.warning("build cache: discarding corrupt index %s" %
+                                    self.index_path)
+
+    def key(self, url, etag, last_modified):
+        """Return the index key of the url and validators or None if
+        there are no validators."""
+        if not etag and not last_modified:
+            return None
+        return "%s\n%s\n%s" % (url, etag or "", last_modified or "")
+
+    def build_path(self, sha1):
+        return os.path.join(self.cachedir, "%s.exe" % sha1)
+
+    def save_index(self):
+        temp_path = self.index_path + ".tmp"
+        index_file = open(temp_path, "w")
+        try:
+            json.dump(self.index, index_file)
+        finally:
+            index_file.close()
+        os.rename(temp_path, self.index_path)
+
+    def lookup(self, url, etag, last_modified):
+        """Return a dict containing the sha1, path and build_info of
+        the cached build for the url and validators or None if the
+        build is not cached.
+        """
+        key = self.key(url, etag, last_modified)
+        with self.lock:
+            sha1 = self.index["keys"].get(key) if key else None
+            build = self.index["builds"].get(sha1) if sha1 else None
+            if build and not os.path.exists(self.build_path(sha1)):
+                self.remove_build(sha1)
+                build = None
+            if not build:
+                self.misses += 1
+                self.logger.info("build cache miss: %s "
+                                 "(hits: %d, misses: %d)" % (url, self.hits,
+                                                             self.misses))
+                return None
+            self.hits += 1
+            self.logger.info("build cache hit: %s %s "
+                             "(hits: %d, misses: %d)" % (url, sha1, self.hits,
+                                                         self.misses))
+            build["used"] = time.time()
+            self.save_index()
+            return {"sha1": sha1,
+                    "path": self.build_path(sha1),
+                    "build_info": build["build_info"]}
+
+    def add(self, url, etag, last_modified, path, build_info, sha1=None):
+        """Add the build installer at path to the cache for the url and
+        validators and return its sha1. The file at path is left in
+        place. Nothing is added if there are no validators.
+        """
+        if not sha1:
+            sha1 = file_digests(path, ["sha1"])["sha1"]
+        key = self.key(url, etag, last_modified)
+        if not key:
+            return sha1
+        with self.lock:
+            if sha1 not in self.index["builds"]:
+                link_or_copy(path, self.build_path(sha1))
+                self.index["builds"][sha1] = {
+                    "size": os.path.getsize(path),
+                    "build_info": build_info,
+                }
+            self.index["builds"][sha1]["used"] = time.time()
+            self.index["keys"][key] = sha1
+            self.evict(sha1)
+            self.save_index()
+        return sha1
+
+    def get_build_info(self, sha1):
+        """Return the cached build information for the build with the
+        given sha1 or None."""
+        with self.lock:
+            build = self.index["builds"].get(sha1)
+            return build["build_info"] if build else None
+
+    def remove_build(self, sha1):
+        build_path = self.build_path(sha1)
+        if os.path.exists(build_path):
+            os.unlink(build_path)
+        del self.index["builds"][sha1]
+        for key, key_sha1 in self.index["keys"].items():
+            if key_sha1 == sha1:
+                del self.index["keys"][key]
+
+    def evict(self, keep_sha1):
+        """Remove the least recently used builds other than keep_sha1
+        until the cache is no larger than max_bytes."""
+        builds = self.index["builds"]
+        total_bytes = sum([build["size"] for build in builds.values()])
+        lru_sha1s = sorted(builds.keys(), key=lambda sha1: builds[sha1]["used"])
+        for sha1 in lru_sha1s:
+            if total_bytes <= self.max_bytes:
+                break
+            if sha1 == keep_sha1:
+                continue
+            total_bytes -= builds[sha1]["size"]
+            self.logger.info("build cache: evicting %s" % sha1)
+            self.remove_build(sha1)
@@ -0,0 +1,135 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+import ConfigParser
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+# Installers are named firefox-<version>.<locale>.win32.installer.exe
+# and are accompanied by firefox-<version>.<locale>.win32.json and
+# .txt files describing the build.
+re_installer = re.compile(r".*/firefox-(.+)\.([a-zA-Z-]+)\.win32\.installer\.exe$")
+
+# build information memoized by the sha1 of the installer.
+build_info_memo = {}
+build_info_memo_lock = threading.Lock()
+
+def get_build_info(installer_path, sha1=None, http=None, url=None):
+    """Return a dict containing the build's name, version, id, branch
+    and revision. If http and url are given, the build's sidecar
+    .json or .txt file is used if available. Otherwise only
+    core/application.ini is extracted from the installer. If sha1 is
+    given, the result is memoized for installers with the same sha1.
+    Raises IOError if application.ini can not be read.
+    """
+    if sha1:
+        with build_info_memo_lock:
+            if sha1 in build_info_memo:
+                return dict(build_info_memo[sha1])
+    build_info = None
+    if http and url:
+        build_info = get_sidecar_build_info(http, url)
+    if not build_info:
+        build_info = get_installer_build_info(installer_path)
+    if sha1:
+        with build_info_memo_lock:
+            build_info_memo[sha1] = dict(build_info)
+    return build_info
+
+def get_sidecar_build_info(http, url):
+    """Return the build information from the .json or .txt file next
+    to the installer url or None if neither is available.
+    """
+    match = re_installer.match(url)
+    if not match:
+        return None
+    version = match.group(1)
+    base_url = url[:-len(".installer.exe")]
+    # The sidecar files are only an optimization so any failure to
+    # retrieve or parse them falls back to reading the installer.
+    try:
+        response, content = http.request(base_url + ".json")
+        if response.status == 200:
+            sidecar = json.loads(content)
+            return {
+                "name": sidecar.get("moz_app_displayname",
+                                    sidecar["moz_app_name"].capitalize()),
+                "version": sidecar["moz_app_version"],
+                "id": sidecar["buildid"],
+                "branch": os.path.basename(sidecar["moz_source_repo"]),
+                "revision": sidecar["moz_source_stamp"],
+            }
+    except Exception:
+        pass
+    try:
+        # buildid on the first line followed by <repository>/rev/<revision>
+        response, content = http.request(base_url + ".txt")
+        if response.status == 200:
+            lines = content.split()
+            if len(lines) >= 2 and "/rev/" in lines[1]:
+                repository, revision = lines[1].split("/rev/", 1)
+                return {
+                    "name": "Firefox",
+                    "version": version,
+                    "id": lines[0],
+                    "branch": os.path.basename(repository),
+                    "revision": revision,
+                }
+    except Exception:
+        pass
+    return None
+
+def get_sidecar_checksum(http, url):
+    """Return a tuple of the hashlib algorithm name and hex digest of
+    the installer url from the build's .checksums file or None if it
+    is not available.
+    """
+    match = re_installer.match(url)
+    if not match:
+        return None
+    installer_name = url.split("/")[-1]
+    checksums_url = url[:-len(".installer.exe")] + ".checksums"
+    try:
+        response, content = http.request(checksums_url)
+    except Exception:
+        return None
+    if response.status != 200:
+        return None
+    # Each line is of the form <digest> <algorithm> <size> <file name>
+    for line in content.splitlines():
+        fields = line.split()
+        if (len(fields) == 4 and fields[1] == "sha512" and
+            fields[3] == installer_name):
+            return (fields[1], fields[0])
+    return None
+
+def get_installer_build_info(installer_path):
+    """Get information about the build by extracting only
+    core/application.ini from the installer to a temporary directory
+    and parsing it.
+    """
+    tempdirectory = tempfile.mkdtemp()
+    try:
+        returncode = subprocess.call(["7z", "x", installer_path,
+                                      "-o%s" % tempdirectory,
+                                      "core/application.ini"])
+        appini = ConfigParser.RawConfigParser()
+        appini.readfp(open("%s/core/application.ini" % tempdirectory))
+        if returncode != 0:
+            raise Exception("get_build_info: "
+                            "error extracting build: rc=%d" % returncode)
+        return {
+            "name": appini.get("App", "name"),
+            "version": appini.get("App", "version"),
+            "id": appini.get("App", "buildID"),
+            "branch": os.path.basename(appini.get("App", "SourceRepository")),
+            "revision": appini.get("App", "SourceStamp"),
+        }
+    finally:
+        shutil.rmtree(tempdirectory)
@@ -0,0 +1,109 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import os
+import sys
+import threading
+
+import httplib2
+
+from buildcache import link_or_copy
+from buildinfo import get_build_info, get_sidecar_checksum
+from httppool import discard, file_digests
+
+class BuildPrefetch(threading.Thread):
+    """Download a build into a staging directory and extract its
+    build information in the background. Once the thread has
+    finished, either exc_info is set to the exception which stopped
+    the prefetch or path contains the build and build_info its
+    information. downloaded is set once the build has been downloaded
+    and verified and md5 and sha1 are the digests of the build.
+
+    If a BuildCache is given, a build which is cached for the url,
+    etag and last_modified is linked into the staging directory
+    instead of being downloaded and new builds are added to it. If
+    neither etag nor last_modified is known, they are revalidated with
+    a HEAD request before the cache is used.
+    """
+    def __init__(self, http, url, stagingdir, cache=None, etag=None,
+                 last_modified=None):
+        super(BuildPrefetch, self).__init__(name="prefetch %s" % url)
+        self.daemon = True
+        self.http = http
+        self.url = url
+        self.cache = cache
+        self.etag = etag
+        self.last_modified = last_modified
+        self.path = os.path.join(stagingdir, "prefetch-%s.exe" %
+                                 hashlib.md5(url).hexdigest())
+        self.downloaded = False
+        self.sha1 = None
+        self.md5 = None
+        self.build_info = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            cached = None
+            if self.cache and not self.etag and not self.last_modified:
+                self.revalidate()
+            if self.cache:
+                cached = self.cache.lookup(self.url, self.etag,
+                                           self.last_modified)
+            if cached:
+                link_or_copy(cached["path"], self.path)
+                self.downloaded = True
+                self.sha1 = cached["sha1"]
+                self.md5 = file_digests(self.path, ["md5"])["md5"]
+                self.build_info = cached["build_info"]
+                return
+            download = self.http.download(
+                self.url, self.path,
+                checksum=get_sidecar_checksum(self.http, self.url))
+            response = download["response"]
+            self.downloaded = True
+            self.sha1 = download["sha1"]
+            self.md5 = download["md5"]
+            # The same build may already be cached under another url.
+            if self.cache:
+                self.build_info = self.cache.get_build_info(self.sha1)
+            if not self.build_info:
+                self.build_info = get_build_info(self.path, sha1=self.sha1,
+                                                 http=self.http, url=self.url)
+            if self.cache:
+                self.cache.add(self.url,
+                               response.get("etag"),
+                               response.get("last-modified"),
+                               self.path, self.build_info, sha1=self.sha1)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def revalidate(self):
+        """Set etag and last_modified from the server's response to a
+        HEAD request for url. A failed request leaves them unset so
+        that the build is downloaded and the download reports the
+        error."""
+        try:
+            response, content = self.http.request(self.url, "HEAD")
+        except (IOError, httplib2.HttpLib2Error):
+            return
+        if response.status == 200:
+            self.etag = response.get("etag")
+            self.last_modified = response.get("last-modified")
+
+    def wait(self):
+        """Wait for the prefetch to finish and raise the exception
+        which stopped it if any.
+        """
+        self.join()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+    def discard(self, partial=True):
+        """Remove the staged build and, if partial is True, any partial
+        download of it."""
+        discard(self.path)
+        if partial:
+            discard(self.path + ".part", self.path + ".part.json")
@@ -1,5 +1,14 @@
 import logging
 import logging.handlers
+import os
+import smtplib
+import socket
+import threading
+import time
+
+from email.utils import formatdate
+
+import jobdb
 
 
 class SMTPHandler(logging.handlers.SMTPHandler):
@@ -21,40 +30,215 @@ class SMTPHandler(logging.handlers.SMTPHandler):
     # IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT
     # OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None,
+                 secure=None, worker=None):
+        logging.handlers.SMTPHandler.__init__(self, mailhost, fromaddr,
+                                              toaddrs, subject,
+                                              credentials=credentials,
+                                              secure=secure)
+        self.worker = worker
+
     def emit(self, record):
         """
         Emit a record.
 
-        Format the record and send it to the specified addressees.
+        Format the record and add it to the worker's outbox to be sent
+        to the specified addressees. Until a worker is set, for example
+        before the database is opened, send it immediately.
         """
         try:
-            import smtplib
-            from email.utils import formatdate
-            port = self.mailport
-            if not port:
-                if self.secure is not None:
-                    port = smtplib.SMTP_SSL_PORT
-                else:
-                    port = smtplib.SMTP_PORT
-            if self.secure is not None:
-                smtp = smtplib.SMTP_SSL(self.mailhost, port)
-            else:
-                smtp = smtplib.SMTP(self.mailhost, port)
             msg = self.format(record)
             msg = "From: %s\r\nTo: %s\r\nSubject: %s\r\nDate: %s\r\n\r\n%s" % (
                             self.fromaddr,
                             ",".join(self.toaddrs),
                             self.getSubject(record),
                             formatdate(), msg)
-            if self.username:
-                #if self.secure is not None:
-                #    smtp.ehlo()
-                #    smtp.starttls(*self.secure)
-                #    smtp.ehlo()
-                smtp.login(self.username, self.password)
-            smtp.sendmail(self.fromaddr, self.toaddrs, msg)
-            smtp.quit()
+            if self.worker:
+                self.worker.put(self.fromaddr, self.toaddrs, msg)
+            else:
+                session = SMTPSession(self.mailhost, self.mailport,
+                                      self.username, self.password,
+                                      self.secure)
+                try:
+                    session.sendmail(self.fromaddr, self.toaddrs, msg)
+                finally:
+                    session.close()
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
+
+
+class SMTPSession(object):
+    """An SMTP connection which is opened and logged in to when the
+    first message is sent and then kept open for the following
+    messages."""
+
+    def __init__(self, mailhost, mailport, username, password, secure):
+        self.mailhost = mailhost
+        self.mailport = mailport
+        self.username = username
+        self.password = password
+        self.secure = secure
+        self.smtp = None
+        self.last_used = None
+
+    def connect(self):
+        port = self.mailport
+        if not port:
+            if self.secure is not None:
+                port = smtplib.SMTP_SSL_PORT
+            else:
+                port = smtplib.SMTP_PORT
+        if self.secure is not None:
+            self.smtp = smtplib.SMTP_SSL(self.mailhost, port)
+        else:
+            self.smtp = smtplib.SMTP(self.mailhost, port)
+        if self.username:
+            self.smtp.login(self.username, self.password)
+
+    def sendmail(self, fromaddr, toaddrs, msg):
+        """Send the message, reconnecting once if the server closed
+        the session since the last message."""
+        if not self.smtp:
+            self.connect()
+        try:
+            self.smtp.sendmail(fromaddr, toaddrs, msg)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            self.connect()
+            self.smtp.sendmail(fromaddr, toaddrs, msg)
+        self.last_used = time.time()
+
+    def close(self):
+        if not self.smtp:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            self.smtp.close()
+        self.smtp = None
+
+
+class Outbox(object):
+    """Add messages to the outbox table for another process's
+    MailWorker to deliver. wptcontroller queues its notifications with
+    an Outbox and calls wake so that wptmonitor's worker sends them.
+    get_connection returns the current thread's database connection.
+    """
+    def __init__(self, get_connection, wake):
+        self.get_connection = get_connection
+        self.wake = wake
+
+    def put(self, fromaddr, toaddrs, msg):
+        """Add the message to the outbox and wake up the worker."""
+        jobdb.enqueue_mail(self.get_connection(), fromaddr, toaddrs, msg)
+        self.wake()
+
+
+class MailWorker(threading.Thread):
+    """Deliver the messages in the outbox table of the database in the
+    background using one SMTP session for as long as there are
+    messages to send.
+
+    put adds a message to the outbox, so that a message survives a
+    restart and the monitor does not wait for the mail server. Each
+    message is claimed by a single worker. A message which can not be delivered is
+    retried after 1, 2, 4, ... minutes up to an hour apart and is
+    dropped after max_attempts attempts. The session is closed after
+    idle_timeout seconds without messages.
+    """
+
+    claim_timeout = 600
+    batch_size = 20
+    poll_interval = 60
+
+    def __init__(self, database, busy_timeout, session, logger,
+                 max_attempts=10, idle_timeout=60):
+        threading.Thread.__init__(self, name="MailWorker")
+        self.daemon = True
+        self.database = database
+        self.busy_timeout = busy_timeout
+        self.session = session
+        self.logger = logger
+        self.max_attempts = max_attempts
+        self.idle_timeout = idle_timeout
+        self.claim = "%s:%d:%d" % (socket.gethostname(), os.getpid(), id(self))
+        self.event = threading.Event()
+        self.stopping = False
+        self.thread_local = threading.local()
+
+    def get_connection(self):
+        connection = getattr(self.thread_local, "connection", None)
+        if connection is None:
+            connection = jobdb.connect(self.database, self.busy_timeout)
+            self.thread_local.connection = connection
+        return connection
+
+    def put(self, fromaddr, toaddrs, msg):
+        """Add the message to the outbox and wake up the worker."""
+        jobdb.enqueue_mail(self.get_connection(), fromaddr, toaddrs, msg)
+        self.event.set()
+
+    def wake(self):
+        """Wake up the worker to deliver messages added to the outbox
+        by another process."""
+        self.event.set()
+
+    def stop(self, timeout=None):
+        """Deliver the messages which are due and stop the worker."""
+        self.stopping = True
+        self.event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        connection = self.get_connection()
+        while True:
+            self.event.clear()
+            try:
+                mailrows = jobdb.claim_mail(connection, self.claim,
+                                            self.batch_size,
+                                            self.claim_timeout)
+                for mailrow in mailrows:
+                    self.deliver(connection, *mailrow)
+            except Exception:
+                # Messages which were claimed are claimed again once
+                # the claim expires.
+                self.logger.exception("MailWorker: error sending messages")
+                mailrows = []
+            if mailrows:
+                continue
+            if self.stopping:
+                break
+            if self.session.smtp:
+                idle = time.time() - self.session.last_used
+                if idle >= self.idle_timeout:
+                    self.session.close()
+                    timeout = self.poll_interval
+                else:
+                    timeout = self.idle_timeout - idle
+            else:
+                timeout = self.poll_interval
+            self.event.wait(timeout)
+        self.session.close()
+
+    def deliver(self, connection, mailid, fromaddr, toaddrs, msg, attempts):
+        try:
+            self.session.sendmail(fromaddr, toaddrs, msg)
+        except (smtplib.SMTPException, socket.error), e:
+            self.session.close()
+            attempts += 1
+            if attempts >= self.max_attempts:
+                self.logger.error("MailWorker: dropping message %d to %s "
+                                  "after %d attempts: %s" %
+                                  (mailid, toaddrs, attempts, e))
+                jobdb.delete_mail(connection, mailid)
+            else:
+                delay = min(60 * 2 ** (attempts - 1), 3600)
+                self.logger.warning("MailWorker: retrying message %d to %s "
+                                    "in %d seconds: %s" %
+                                    (mailid, toaddrs, delay, e))
+                jobdb.retry_mail(connection, mailid, attempts, delay)
+            return
+        jobdb.delete_mail(connection, mailid)
@@ -0,0 +1,414 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+import Queue
+import hashlib
+import httplib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+import httplib2
+
+from multiprocessing.pool import ThreadPool
+
+# The exceptions raised by a connection while a response is streamed.
+STREAM_ERRORS = (socket.error, httplib.HTTPException, httplib2.HttpLib2Error)
+
+def get_proxy_info(scheme):
+    """ Work around http://code.google.com/p/httplib2/issues/detail?id=228
+    Squid proxies are typically configured to prevent socket connect on http
+    ports. get_proxy_info forces the proxy to use socks.PROXY_TYPE_HTTP_NO_TUNNEL
+    for http to work around the issue.
+    bc: The current squid proxy will still fail with a status 400 Invalid Request
+    'x-squid-error': 'ERR_INVALID_URL 0.
+    """
+    if hasattr(httplib2, 'proxy_info_from_environment'):
+        # httplib2 0.8
+        proxy_info = httplib2.proxy_info_from_environment()
+    elif hasattr(httplib2.ProxyInfo, 'from_environment'):
+        # httplib2 0.7.x
+        proxy_info = httplib2.ProxyInfo.from_environment()
+    else:
+        proxy_info = None
+    if (proxy_info and scheme == 'http' and
+        hasattr(httplib2.socks, 'PROXY_TYPE_HTTP_NO_TUNNEL')):
+        proxy_info.proxy_type = httplib2.socks.PROXY_TYPE_HTTP_NO_TUNNEL
+    return proxy_info
+
+def file_digests(path, algorithms):
+    """Return a dict mapping each of the hashlib algorithms to the hex
+    digest of the file's contents."""
+    hashes = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+    infile = open(path, "rb")
+    try:
+        while True:
+            data = infile.read(1024 * 1024)
+            if not data:
+                break
+            for algorithm, hash in hashes:
+                hash.update(data)
+    finally:
+        infile.close()
+    return dict([(algorithm, hash.hexdigest()) for algorithm, hash in hashes])
+
+def discard(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+
+class HttpPool(object):
+    """A thread safe pool of httplib2.Http clients which keep their
+    connections alive between requests. Each host has its own set of
+    at most max_connections clients. A request for a host whose
+    clients are all busy waits until one is returned to the pool.
+    Downloads which support byte ranges are fetched in chunk_size
+    ranges using download_workers concurrent requests. A download
+    which fails is resumed up to download_attempts times in all.
+    """
+    # seconds to wait before the second attempt at a download, growing
+    # with each later attempt.
+    retry_delay = 5
+
+    def __init__(self, max_connections=4, timeout=None,
+                 chunk_size=4194304, download_workers=1,
+                 download_attempts=3):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.download_workers = download_workers
+        self.download_attempts = download_attempts
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.created = {}
+        self.host_stats = {}
+
+    def acquire(self, host):
+        with self.lock:
+            if host not in self.idle:
+                self.idle[host] = Queue.Queue()
+                self.created[host] = 0
+                self.host_stats[host] = {"requests": 0,
+                                         "errors": 0,
+                                         "seconds": 0.0,
+                                         "max_seconds": 0.0}
+            idle = self.idle[host]
+            if idle.empty() and self.created[host] < self.max_connections:
+                self.created[host] += 1
+                return httplib2.Http(proxy_info=get_proxy_info,
+                                     timeout=self.timeout)
+        return idle.get()
+
+    def release(self, host, http):
+        self.idle[host].put(http)
+
+    def request(self, url, method="GET", body=None, headers=None):
+        """Perform the request using a pooled client for the url's host
+        and return the httplib2 (response, content) tuple.
+        """
+        host = urlparse.urlparse(url).netloc
+        http = self.acquire(host)
+        start = time.time()
+        error = True
+        try:
+            response, content = http.request(url, method, body=body,
+                                             headers=headers)
+            error = False
+            return response, content
+        finally:
+            self.release(host, http)
+            self.record(host, time.time() - start, error)
+
+    def record(self, host, elapsed, error):
+        with self.lock:
+            stats = self.host_stats.setdefault(host, {"requests": 0,
+                                                      "errors": 0,
+                                                      "seconds": 0.0,
+                                                      "max_seconds": 0.0})
+            stats["requests"] += 1
+            stats["seconds"] += elapsed
+            stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+            if error:
+                stats["errors"] += 1
+
+    def open(self, url, headers=None):
+        """Return a PooledResponse from which the body of the response
+        to a GET request for url is streamed. Unlike request, the
+        response is not held in memory. The request uses a keep-alive
+        connection of a pooled client for the url's host, which is
+        returned to the pool when the PooledResponse is closed. Raises
+        IOError if the request fails or its status is not 200.
+        """
+        (scheme, authority, request_uri, defrag_uri) = httplib2.urlnorm(url)
+        host = urlparse.urlparse(url).netloc
+        http = self.acquire(host)
+        start = time.time()
+        response = None
+        try:
+            conn = self.connection(http, scheme, authority)
+            response = self.get_response(conn, request_uri, headers or {})
+        except STREAM_ERRORS, e:
+            raise IOError("Error retrieving %s: %s" % (url, e))
+        finally:
+            if response is None:
+                self.release(host, http)
+                self.record(host, time.time() - start, True)
+        pooled = PooledResponse(self, url, host, http, conn, response, start)
+        if response.status != 200:
+            pooled.close(error=True)
+            raise IOError("Error retrieving %s: status %s" % (url,
+                                                              response.status))
+        return pooled
+
+    def connection(self, http, scheme, authority):
+        """Return the keep-alive connection of the httplib2.Http client
+        http for scheme and authority, creating it with the proxy
+        settings of get_proxy_info as httplib2 does."""
+        conn_key = scheme + ":" + authority
+        conn = http.connections.get(conn_key)
+        if conn is None:
+            proxy_info = get_proxy_info(scheme)
+            hostname = urllib.splitport(authority)[0]
+            if (hasattr(proxy_info, "applies_to") and
+                not proxy_info.applies_to(hostname)):
+                proxy_info = None
+            conn = http.connections[conn_key] = (
+                httplib2.SCHEME_TO_CONNECTION[scheme](
+                    authority, timeout=self.timeout, proxy_info=proxy_info))
+        return conn
+
+    def get_response(self, conn, request_uri, headers):
+        """Send a GET request for request_uri on conn and return the
+        httplib response. A kept alive connection which the server
+        has since closed is reconnected once."""
+        for attempt in (1, 2):
+            reused = getattr(conn, "sock", None) is not None
+            try:
+                if not reused:
+                    conn.connect()
+                conn.request("GET", request_uri, headers=headers)
+                return conn.getresponse()
+            except STREAM_ERRORS:
+                conn.close()
+                if not reused or attempt == 2:
+                    raise
+
+    def download(self, url, path, checksum=None):
+        """Download url to path and return a dict containing the
+        server's response to the HEAD request for url and the md5 and
+        sha1 hex digests of the download. If checksum is given as a
+        tuple of a hashlib algorithm name and hex digest, the download
+        is verified against it. Raises IOError if the download fails.
+
+        The download is written to path.part and only renamed to path
+        once it is complete and verified. If the server supports byte
+        ranges, url is fetched in ranges and the completed ranges are recorded in
+        path.part.json so that an interrupted download resumes where
+        it stopped as long as the server's ETag or Last-Modified
+        header for url has not changed. A failed attempt leaves path.part
+        and path.part.json in place, both for the next attempt and for a
+        later call, which resumes the download. They are only discarded
+        if the download fails verification or url has changed.
+        """
+        part_path = path + ".part"
+        state_path = path + ".part.json"
+        attempt = 1
+        while True:
+            try:
+                (response, length, complete) = self.download_attempt(
+                    url, part_path, state_path)
+                # path.part already has the length of a ranged download,
+                # so its size does not show whether every range was
+                # written.
+                if not complete:
+                    raise IOError("Error retrieving %s: download incomplete" %
+                                  url)
+                break
+            except IOError:
+                if attempt >= self.download_attempts:
+                    raise
+                time.sleep(self.retry_delay * attempt)
+                attempt += 1
+        algorithms = ["md5", "sha1"]
+        if checksum and checksum[0] not in algorithms:
+            algorithms.append(checksum[0])
+        digests = file_digests(part_path, algorithms)
+        if ((length and os.path.getsize(part_path) != length) or
+            (checksum and digests[checksum[0]] != checksum[1])):
+            discard(part_path, state_path)
+            raise IOError("Error retrieving %s: download failed verification" %
+                          url)
+        os.rename(part_path, path)
+        discard(state_path)
+        return {"response": response,
+                "md5": digests["md5"],
+                "sha1": digests["sha1"]}
+
+    def download_attempt(self, url, part_path, state_path):
+        """Download url to part_path, resuming from state_path if
+        possible, and return the tuple of the response to the HEAD
+        request, the length of url and whether part_path is known to
+        be complete."""
+        try:
+            response, content = self.request(url, "HEAD")
+        except httplib2.HttpLib2Error, e:
+            raise IOError("Error retrieving %s: %s" % (url, e))
+        if response.status != 200:
+            raise IOError("Error retrieving %s: status %s" % (url,
+                                                              response.status))
+        length = int(response.get("content-length", 0))
+        validator = response.get("etag") or response.get("last-modified")
+        if (response.get("accept-ranges") == "bytes" and length and
+            validator):
+            complete = self.download_ranges(url, part_path, state_path,
+                                            length, validator)
+        else:
+            discard(state_path)
+            self.download_whole(url, part_path)
+            complete = True
+        return (response, length, complete)
+
+    def download_whole(self, url, part_path):
+        """Stream url to part_path for servers which do not support
+        byte ranges."""
+        infile = self.open(url)
+        try:
+            outfile = open(part_path, "wb")
+            try:
+                shutil.copyfileobj(infile, outfile, 1024 * 1024)
+            finally:
+                outfile.close()
+        finally:
+            infile.close()
+
+    def download_ranges(self, url, part_path, state_path, length, validator):
+        """Download the ranges of url which state_path does not record
+        as done into part_path and return True if every range has been
+        written."""
+        state = None
+        if os.path.exists(part_path) and os.path.exists(state_path):
+            try:
+                state = json.load(open(state_path))
+            except ValueError:
+                pass
+        if (not state or state.get("validator") != validator or
+            state.get("length") != length or
+            os.path.getsize(part_path) != length):
+            state = {"validator": validator, "length": length, "done": []}
+            outfile = open(part_path, "wb")
+            outfile.truncate(length)
+            outfile.close()
+        state_lock = threading.Lock()
+        done = set(state["done"])
+        starts = range(0, length, self.chunk_size)
+        chunks = [(start, min(start + self.chunk_size, length) - 1)
+                  for start in starts if start not in done]
+
+        def download_chunk(chunk):
+            (start, end) = chunk
+            # If-Range makes the server return the entire url rather
+            # than the range if it has changed.
+            try:
+                response, content = self.request(
+                    url, headers={"Range": "bytes=%d-%d" % (start, end),
+                                  "If-Range": validator})
+            except httplib2.HttpLib2Error, e:
+                raise IOError("Error retrieving %s: %s" % (url, e))
+            if response.status != 206 or len(content) != end - start + 1:
+                raise IOError("Error retrieving %s bytes %d-%d: status %s" % (
+                    url, start, end, response.status))
+            outfile = open(part_path, "r+b")
+            try:
+                outfile.seek(start)
+                outfile.write(content)
+            finally:
+                outfile.close()
+            with state_lock:
+                state["done"].append(start)
+                state_file = open(state_path, "w")
+                try:
+                    json.dump(state, state_file)
+                finally:
+                    state_file.close()
+
+        if self.download_workers > 1 and len(chunks) > 1:
+            pool = ThreadPool(min(self.download_workers, len(chunks)))
+            try:
+                pool.map(download_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for chunk in chunks:
+                download_chunk(chunk)
+        return set(state["done"]).issuperset(starts)
+
+    def stats(self):
+        """Return a dict mapping each host to a dict containing the
+        number of requests, errors, and the mean and maximum request
+        latency in seconds.
+        """
+        with self.lock:
+            host_stats = {}
+            for host, stats in self.host_stats.items():
+                host_stats[host] = dict(stats)
+                host_stats[host]["mean_seconds"] = (
+                    stats["seconds"] / stats["requests"] if stats["requests"]
+                    else 0.0)
+            return host_stats
+
+class PooledResponse(object):
+    """A file like object for the body of a response streamed by
+    HttpPool.open. read raises IOError if the connection fails. Closing
+    it returns the client to the pool, keeping its connection alive if
+    the body was read to the end.
+    """
+    def __init__(self, pool, url, host, http, conn, response, start):
+        self.pool = pool
+        self.url = url
+        self.host = host
+        self.http = http
+        self.conn = conn
+        self.response = response
+        self.start = start
+        self.status = response.status
+        self.error = False
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, size=-1):
+        try:
+            if size < 0:
+                data = self.response.read()
+            else:
+                data = self.response.read(size)
+        except STREAM_ERRORS, e:
+            self.error = True
+            raise IOError("Error retrieving %s: %s" % (self.url, e))
+        # httplib returns a body which ends before its Content-Length
+        # as if it were complete when it is read in parts.
+        if size and not data and self.response.length:
+            self.error = True
+            raise IOError("Error retrieving %s: %d bytes missing" % (
+                self.url, self.response.length))
+        return data
+
+    def close(self, error=False):
+        if self.http is None:
+            return
+        if not self.response.isclosed():
+            # The rest of the body would be read by the next request
+            # on the connection.
+            self.response.close()
+            self.conn.close()
+        self.pool.release(self.host, self.http)
+        self.pool.record(self.host, time.time() - self.start,
+                         error or self.error)
+        self.http = None
@@ -0,0 +1,674 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+# The jobs database shared by wptcontroller and wptmonitor.
+#
+# The schema is versioned using PRAGMA user_version. Each entry of
+# MIGRATIONS upgrades the schema by one version and is applied in its
+# own transaction, so a database created by an earlier version of
+# wptcontroller is upgraded in place the next time it is opened.
+#
+# Job statuses are stored as the integer codes WAITING, PENDING,
+# RUNNING and COMPLETED and the started and timestamp columns are
+# stored as integer seconds since the epoch.
+#
+# insert_job and delete_jobs write a job together with its locations,
+# speeds and urls in a single transaction so that a partially written
+# job is never visible to the other process.
+#
+# The outbox table holds the email messages waiting to be delivered by
+# emailhandler.MailWorker.
+#
+# The meta table's jobs_changes counter is incremented by triggers on
+# every change to the jobs table. wptcontroller uses it as the ETag of
+# its job API responses.
+#
+# The results of each test are kept after its job is purged. A series
+# is the history of one metric of one view of a url at a location and
+# connectivity. result_values is clustered by series and time so that
+# the history of a series is read from a single range of the table.
+# result_baselines holds the rolling window of the per-test medians of
+# each series which wptregress compares each new test with.
+
+import json
+import sqlite3
+import time
+
+WAITING = 0
+PENDING = 1
+RUNNING = 2
+COMPLETED = 3
+
+STATUS_NAMES = {WAITING: "waiting",
+                PENDING: "pending",
+                RUNNING: "running",
+                COMPLETED: "completed"}
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+def status_name(status):
+    """Return the name of the status code or status unchanged if it is
+    not a status code."""
+    return STATUS_NAMES.get(status, status)
+
+def format_time(seconds):
+    """Return the local time seconds since the epoch as text or "" if
+    seconds is None."""
+    if seconds is None:
+        return ""
+    return time.strftime(TIME_FORMAT, time.localtime(seconds))
+
+def legacy_epoch(text):
+    """Convert a version 1 local time text timestamp to seconds since
+    the epoch."""
+    if not text:
+        return None
+    try:
+        return int(time.mktime(time.strptime(text, TIME_FORMAT)))
+    except ValueError:
+        return None
+
+# version 1: the original schema with text columns.
+SCHEMA_V1 = [
+    "create table if not exists jobs ("
+    "id integer primary key autoincrement, "
+    "email text, "
+    "build text, "
+    "label text, "
+    "runs text, "
+    "tcpdump text, "
+    "video text, "
+    "datazilla text, "
+    "prescript text, "
+    "postscript text, "
+    "status text, "
+    "started text, "
+    "timestamp text"
+    ")",
+    "create table if not exists locations ("
+    "id integer primary key autoincrement, "
+    "location text, "
+    "jobid references jobs(id)"
+    ")",
+    "create table if not exists speeds ("
+    "id integer primary key autoincrement, "
+    "speed text, "
+    "jobid references jobs(id)"
+    ")",
+    "create table if not exists urls ("
+    "id integer primary key autoincrement, "
+    "url text, "
+    "script text, "
+    "jobid references jobs(id)"
+    ")",
+]
+
+# version 2: rebuild jobs with an integer runs column, integer status
+# codes and integer epoch timestamps. Unknown statuses become RUNNING
+# so that check_running_jobs cleans up the job.
+SCHEMA_V2 = [
+    "create table jobs_v2 ("
+    "id integer primary key autoincrement, "
+    "email text, "
+    "build text, "
+    "label text, "
+    "runs integer, "
+    "tcpdump text, "
+    "video text, "
+    "datazilla text, "
+    "prescript text, "
+    "postscript text, "
+    "status integer not null, "
+    "started integer, "
+    "timestamp integer"
+    ")",
+    "insert into jobs_v2 "
+    "select id, email, build, label, runs, tcpdump, video, datazilla, "
+    "prescript, postscript, "
+    "case status "
+    "when 'waiting' then %d "
+    "when 'pending' then %d "
+    "when 'running' then %d "
+    "when 'completed' then %d "
+    "else %d end, "
+    "legacy_epoch(started), legacy_epoch(timestamp) "
+    "from jobs" % (WAITING, PENDING, RUNNING, COMPLETED, RUNNING),
+    "drop table jobs",
+    "alter table jobs_v2 rename to jobs",
+]
+
+# version 3: indexes for the monitor's queries by status in started
+# order and for the lookups of a job's locations, speeds and urls.
+SCHEMA_V3 = [
+    "create index jobs_status_started on jobs(status, started)",
+    "create index jobs_started on jobs(started)",
+    "create index locations_jobid on locations(jobid)",
+    "create index speeds_jobid on speeds(jobid)",
+    "create index urls_jobid on urls(jobid)",
+]
+
+# version 4: the outbox of email messages. A message is claimed by a
+# worker by setting claim to a value unique to the worker and claimed
+# to the time it was claimed.
+SCHEMA_V4 = [
+    "create table outbox ("
+    "id integer primary key autoincrement, "
+    "fromaddr text not null, "
+    "toaddrs text not null, "
+    "message text not null, "
+    "created integer not null, "
+    "attempts integer not null default 0, "
+    "next_attempt integer not null, "
+    "claim text, "
+    "claimed integer"
+    ")",
+    "create index outbox_next_attempt on outbox(next_attempt)",
+]
+
+# version 5: whether the job's user is notified of each step of the
+# job immediately rather than by a digest when the job completes.
+SCHEMA_V5 = [
+    "alter table jobs add column immediate integer not null default 0",
+]
+
+# version 6: a counter of the changes to jobs. The locations, speeds
+# and urls of a job are only written in the same transaction as the
+# job, so the triggers on jobs alone count every change to a job.
+SCHEMA_V6 = [
+    "create table meta ("
+    "name text primary key, "
+    "value integer not null"
+    ")",
+    "insert into meta(name, value) values ('jobs_changes', 0)",
+] + [
+    "create trigger jobs_%s_changes after %s on jobs begin "
+    "update meta set value = value + 1 where name = 'jobs_changes'; "
+    "end" % (event, event)
+    for event in ("insert", "update", "delete")
+]
+
+# version 7: the results store.
+SCHEMA_V7 = [
+    "create table result_tests ("
+    "id integer primary key autoincrement, "
+    "test_id text not null unique, "
+    "jobid integer, "
+    "label text, "
+    "build_revision text, "
+    "build_id text, "
+    "completed integer not null"
+    ")",
+    "create index result_tests_build_revision on "
+    "result_tests(build_revision)",
+    "create table result_series ("
+    "id integer primary key autoincrement, "
+    "url text not null, "
+    "location text not null, "
+    "connectivity text not null, "
+    "view text not null, "
+    "metric text not null, "
+    "unique (url, location, connectivity, view, metric)"
+    ")",
+    "create table result_values ("
+    "series integer not null references result_series(id), "
+    "completed integer not null, "
+    "test integer not null references result_tests(id), "
+    "run integer not null, "
+    "value real not null, "
+    "primary key (series, completed, test, run)"
+    ") without rowid",
+]
+
+# version 8: the baseline of each series as the JSON list of the
+# medians of the most recent tests up to and including test.
+SCHEMA_V8 = [
+    "create table result_baselines ("
+    "series integer primary key references result_series(id), "
+    "test integer not null references result_tests(id), "
+    "medians text not null"
+    ")",
+]
+
+MIGRATIONS = [SCHEMA_V1, SCHEMA_V2, SCHEMA_V3, SCHEMA_V4, SCHEMA_V5,
+              SCHEMA_V6, SCHEMA_V7, SCHEMA_V8]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def connect(database, busy_timeout=30):
+    """Return a connection to database in WAL mode which waits up to
+    busy_timeout seconds for a lock held by another process.
+    """
+    connection = sqlite3.connect(database, timeout=busy_timeout)
+    connection.execute("PRAGMA busy_timeout = %d;" % (busy_timeout * 1000))
+    connection.execute("PRAGMA journal_mode = WAL;").fetchone()
+    connection.execute("PRAGMA foreign_keys = ON;")
+    return connection
+
+def get_version(connection):
+    return connection.execute("PRAGMA user_version;").fetchone()[0]
+
+def migrate(connection):
+    """Upgrade the database to SCHEMA_VERSION and return the version
+    it had before.
+
+    Both wptcontroller and wptmonitor may open the database at the
+    same time, so each migration checks the version again after
+    acquiring the write lock.
+    """
+    initial_version = get_version(connection)
+    if initial_version >= SCHEMA_VERSION:
+        return initial_version
+    connection.create_function("legacy_epoch", 1, legacy_epoch)
+    # sqlite3 implicitly commits before schema changes unless the
+    # transactions are managed here. Foreign keys can not be toggled
+    # inside a transaction and must be off while jobs is rebuilt.
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    connection.execute("PRAGMA foreign_keys = OFF;")
+    try:
+        while True:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                version = get_version(connection)
+                if version >= SCHEMA_VERSION:
+                    connection.execute("COMMIT")
+                    break
+                for statement in MIGRATIONS[version]:
+                    connection.execute(statement)
+                connection.execute("PRAGMA user_version = %d;" % (version + 1))
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+    finally:
+        connection.execute("PRAGMA foreign_keys = ON;")
+        connection.isolation_level = isolation_level
+    return initial_version
+
+def insert_job(connection, email, build, label, runs, tcpdump, video,
+               datazilla, prescript, postscript, locations, speeds, urls,
+               scripts, immediate=False):
+    """Insert a waiting job with its locations, speeds and urls and
+    return its id. scripts contains the text of the script for each
+    url. Nothing is inserted if any of the inserts fail.
+    """
+    with connection:
+        cursor = connection.execute(
+            "insert into jobs(email, build, label, runs, tcpdump, video, "
+            "datazilla, prescript, postscript, status, started, immediate) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (email, build, label, runs, tcpdump, video,
+             datazilla, prescript, postscript, WAITING, int(time.time()),
+             1 if immediate else 0))
+        jobid = cursor.lastrowid
+        connection.executemany(
+            "insert into locations(location, jobid) values (?, ?)",
+            [(location, jobid) for location in locations])
+        connection.executemany(
+            "insert into speeds(speed, jobid) values (?, ?)",
+            [(speed, jobid) for speed in speeds])
+        connection.executemany(
+            "insert into urls(url, script, jobid) values (?, ?, ?)",
+            [(urls[iurl], scripts[iurl], jobid) for iurl in range(len(urls))])
+    return jobid
+
+def delete_jobs(connection, jobids):
+    """Delete the jobs whose ids are in jobids along with their
+    locations, speeds and urls."""
+    jobparms = [(jobid,) for jobid in jobids]
+    with connection:
+        for table in ("urls", "speeds", "locations"):
+            connection.executemany("delete from %s where jobid=?" % table,
+                                   jobparms)
+        connection.executemany("delete from jobs where id=?", jobparms)
+
+def get_jobs_changes(connection):
+    """Return the number of changes made to jobs since the database
+    was created."""
+    return connection.execute(
+        "select value from meta where name = 'jobs_changes'").fetchone()[0]
+
+def jobs_where(status=None, email=None, label=None):
+    """Return the where clause and its parameters which select the
+    jobs matching each of status, email and label which is not None."""
+    conditions = []
+    params = {}
+    for column, value in (("status", status), ("email", email),
+                          ("label", label)):
+        if value is not None:
+            conditions.append("%s = :%s" % (column, column))
+            params[column] = value
+    if not conditions:
+        return ("", params)
+    return (" where " + " and ".join(conditions), params)
+
+def count_jobs(connection, status=None, email=None, label=None):
+    (where, params) = jobs_where(status, email, label)
+    return connection.execute("select count(*) from jobs" + where,
+                              params).fetchone()[0]
+
+def select_jobs(connection, where, params):
+    """Return the jobs selected by the where clause. Each job is the
+    tuple of the jobs row followed by the lists of its locations,
+    speeds and urls."""
+    params = dict(params, sep="\n")
+    jobrows = connection.execute(
+        "select jobs.*, "
+        "(select group_concat(location, :sep) from locations "
+        "where jobid = jobs.id), "
+        "(select group_concat(speed, :sep) from speeds "
+        "where jobid = jobs.id), "
+        "(select group_concat(url, :sep) from urls "
+        "where jobid = jobs.id) "
+        "from jobs" + where, params).fetchall()
+    return [tuple(jobrow[:-3]) +
+            tuple([values.split("\n") if values else []
+                   for values in jobrow[-3:]])
+            for jobrow in jobrows]
+
+def list_jobs(connection, limit, offset=0, status=None, email=None,
+              label=None):
+    """Return up to limit jobs matching status, email and label in the
+    order they were submitted, skipping the first offset jobs."""
+    (where, params) = jobs_where(status, email, label)
+    params.update({"limit": limit, "offset": offset})
+    return select_jobs(connection,
+                       where + " order by started, id "
+                       "limit :limit offset :offset", params)
+
+def get_job(connection, jobid):
+    """Return the job jobid or None if it does not exist."""
+    jobs = select_jobs(connection, " where id = :jobid", {"jobid": jobid})
+    if not jobs:
+        return None
+    return jobs[0]
+
+def enqueue_mail(connection, fromaddr, toaddrs, message):
+    """Add the message to the outbox to be delivered as soon as
+    possible and return its id. toaddrs is a list of addresses."""
+    now = int(time.time())
+    with connection:
+        cursor = connection.execute(
+            "insert into outbox(fromaddr, toaddrs, message, created, "
+            "next_attempt) values (?, ?, ?, ?, ?)",
+            (fromaddr, ",".join(toaddrs), message, now, now))
+    return cursor.lastrowid
+
+def claim_mail(connection, claim, limit, claim_timeout):
+    """Claim up to limit messages which are due to be delivered and
+    return a list of (id, fromaddr, toaddrs, message, attempts) tuples.
+    Messages claimed more than claim_timeout seconds ago by a worker
+    which did not deliver them may be claimed again. The claim is a
+    single update so that a message is only claimed by one worker.
+    """
+    now = int(time.time())
+    with connection:
+        connection.execute(
+            "update outbox set claim=:claim, claimed=:now "
+            "where id in (select id from outbox where next_attempt <= :now "
+            "and (claim is null or claimed < :expired) "
+            "order by id limit :limit)",
+            {"claim": claim, "now": now, "expired": now - claim_timeout,
+             "limit": limit})
+    mailrows = connection.execute(
+        "select id, fromaddr, toaddrs, message, attempts from outbox "
+        "where claim=:claim and claimed=:now order by id",
+        {"claim": claim, "now": now}).fetchall()
+    return [(mailid, fromaddr, toaddrs.split(","), message, attempts)
+            for (mailid, fromaddr, toaddrs, message, attempts) in mailrows]
+
+def delete_mail(connection, mailid):
+    with connection:
+        connection.execute("delete from outbox where id=?", (mailid,))
+
+def retry_mail(connection, mailid, attempts, delay):
+    """Release the claimed message to be delivered again in delay
+    seconds after attempts unsuccessful attempts."""
+    with connection:
+        connection.execute(
+            "update outbox set attempts=?, next_attempt=?, claim=null, "
+            "claimed=null where id=?",
+            (attempts, int(time.time()) + delay, mailid))
+
+def insert_results(connection, test_id, jobid, label, build_revision,
+                   build_id, wpt_data, wpt_runs, completed=None):
+    """Store the metrics of each run and view of the test from the
+    wpt_data built by JobMonitor.get_wpt_data in one transaction and
+    return the number of values stored. wpt_runs holds the run number
+    of each value of wpt_data. A test which is already stored is not
+    stored again.
+    """
+    if completed is None:
+        completed = int(time.time())
+    values = []
+    for view in ("firstView", "repeatView"):
+        view_runs = wpt_runs[view]
+        for metric, metric_values in wpt_data[view].items():
+            for ivalue in range(len(metric_values)):
+                values.append((view, metric, view_runs[metric][ivalue],
+                               metric_values[ivalue]))
+    key = {"url": wpt_data["url"], "location": wpt_data["location"],
+           "connectivity": wpt_data["connectivity"]}
+    with connection:
+        cursor = connection.execute(
+            "insert or ignore into result_tests(test_id, jobid, label, "
+            "build_revision, build_id, completed) values (?, ?, ?, ?, ?, ?)",
+            (test_id, jobid, label, build_revision, build_id, completed))
+        if not cursor.rowcount:
+            return 0
+        test = cursor.lastrowid
+        connection.executemany(
+            "insert or ignore into result_series(url, location, "
+            "connectivity, view, metric) values "
+            "(:url, :location, :connectivity, :view, :metric)",
+            [dict(key, view=view, metric=metric)
+             for (view, metric) in set([(view, metric) for
+                                        (view, metric, run, value) in values])])
+        series_map = {}
+        for (series, view, metric) in connection.execute(
+                "select id, view, metric from result_series "
+                "where url = :url and location = :location and "
+                "connectivity = :connectivity", key):
+            series_map[(view, metric)] = series
+        connection.executemany(
+            "insert into result_values(series, completed, test, run, value) "
+            "values (?, ?, ?, ?, ?)",
+            [(series_map[(view, metric)], completed, test, run, value)
+             for (view, metric, run, value) in values])
+    return len(values)
+
+def result_history(connection, url, location, connectivity, view, metric,
+                   since=0, until=None):
+    """Return the list of (completed, build_revision, test_id, run,
+    value) tuples of the series between the times since and until in
+    seconds since the epoch in the order they were stored."""
+    if until is None:
+        until = int(time.time())
+    return connection.execute(
+        "select result_values.completed, build_revision, test_id, run, value "
+        "from result_series "
+        "join result_values on result_values.series = result_series.id "
+        "join result_tests on result_tests.id = result_values.test "
+        "where url = ? and location = ? and connectivity = ? and "
+        "view = ? and metric = ? and "
+        "result_values.completed between ? and ? "
+        "order by result_values.completed, result_values.test, run",
+        (url, location, connectivity, view, metric, since,
+         until)).fetchall()
+
+def get_result_test(connection, test_id):
+    """Return the id of the stored test test_id or None."""
+    row = connection.execute("select id from result_tests where test_id = ?",
+                             (test_id,)).fetchone()
+    if not row:
+        return None
+    return row[0]
+
+def get_series(connection, url, location, connectivity):
+    """Return a dict mapping (view, metric) to the id of each series of
+    url at location and connectivity."""
+    series_map = {}
+    for (series, view, metric) in connection.execute(
+            "select id, view, metric from result_series "
+            "where url = ? and location = ? and connectivity = ?",
+            (url, location, connectivity)):
+        series_map[(view, metric)] = series
+    return series_map
+
+def get_baselines(connection, series_ids):
+    """Return a dict mapping each of series_ids which has a baseline to
+    the tuple of the last test in the baseline and its medians."""
+    baselines = {}
+    series_ids = list(series_ids)
+    # Stay below sqlite's default limit of 999 parameters.
+    for start in range(0, len(series_ids), 500):
+        chunk = series_ids[start:start + 500]
+        for (series, test, medians) in connection.execute(
+                "select series, test, medians from result_baselines "
+                "where series in (%s)" % ", ".join(["?"] * len(chunk)),
+                chunk):
+            baselines[series] = (test, json.loads(medians))
+    return baselines
+
+def set_baselines(connection, baselines):
+    """Store the baselines given as a list of (series, test, medians)
+    tuples."""
+    with connection:
+        connection.executemany(
+            "insert or replace into result_baselines(series, test, medians) "
+            "values (?, ?, ?)",
+            [(series, test, json.dumps(medians))
+             for (series, test, medians) in baselines])
+
+def recent_test_values(connection, series, test, ntests):
+    """Return the lists of the values of the runs of the last ntests
+    tests of the series other than test, oldest first. This reads the
+    history of the series and is only used to start a baseline."""
+    rows = connection.execute(
+        "select test, value from result_values "
+        "where series = :series and test != :test and completed >= "
+        "(select coalesce(min(completed), 0) from "
+        "(select distinct completed, test from result_values "
+        "where series = :series and test != :test "
+        "order by completed desc, test desc limit :ntests)) "
+        "order by completed, test, run",
+        {"series": series, "test": test, "ntests": ntests}).fetchall()
+    tests = []
+    test_values = []
+    for (value_test, value) in rows:
+        if not tests or tests[-1] != value_test:
+            tests.append(value_test)
+            test_values.append([])
+        test_values[-1].append(value)
+    return test_values[-ntests:]
+
+if __name__ == "__main__":
+    # Benchmark the monitor's and controller's queries against 100,000
+    # historical jobs before and after upgrading a version 1 database.
+    import os
+    import random
+    import tempfile
+    import timeit
+
+    njobs = 100000
+    tempdirectory = tempfile.mkdtemp()
+    database = os.path.join(tempdirectory, "jobmanager.sqlite")
+
+    connection = sqlite3.connect(database)
+    for statement in SCHEMA_V1:
+        connection.execute(statement)
+    connection.execute("PRAGMA user_version = 1;")
+    random.seed(0)
+    start = time.mktime(time.strptime("2013-01-01T00:00:00", TIME_FORMAT))
+    jobrows = []
+    for jobid in range(1, njobs + 1):
+        status = ("waiting" if jobid % 1000 == 0 else
+                  "pending" if jobid % 1000 == 1 else "completed")
+        started = time.strftime(TIME_FORMAT,
+                                time.localtime(start + jobid * 60))
+        jobrows.append((jobid, "user@example.com",
+                        "https://ftp.mozilla.org/builds/%d/" % (jobid % 500),
+                        "label", "3", "on", "on", "", "", "", status,
+                        started, started))
+    connection.executemany("insert into jobs values "
+                           "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", jobrows)
+    for table, column in (("locations", "location"), ("speeds", "speed"),
+                          ("urls", "url")):
+        connection.executemany(
+            "insert into %s(%s, jobid) values (?, ?)" % (table, column),
+            [("%s%d" % (column, i), jobid)
+             for jobid in range(1, njobs + 1) for i in range(2)])
+    connection.commit()
+
+    lookup_jobids = [random.randint(1, njobs) for i in range(200)]
+
+    def benchmark(connection, pending, waiting):
+        queries = [
+            ("oldest pending job",
+             lambda: connection.execute(
+                 "select * from jobs where status = ? order by started",
+                 (pending,)).fetchone()),
+            ("waiting builds",
+             lambda: connection.execute(
+                 "select distinct build from jobs where status = ?",
+                 (waiting,)).fetchall()),
+            ("200 job location lookups",
+             lambda: [connection.execute(
+                 "select location from locations where jobid = ?",
+                 (jobid,)).fetchall() for jobid in lookup_jobids]),
+        ]
+        for name, query in queries:
+            seconds = min(timeit.repeat(query, repeat=3, number=5)) / 5
+            print "  %-26s %10.3f ms" % (name, seconds * 1000)
+
+    print "%d jobs, version 1 schema, rollback journal:" % njobs
+    benchmark(connection, "pending", "waiting")
+    connection.close()
+
+    connection = connect(database)
+    seconds = time.time()
+    migrate(connection)
+    print "migrated to version %d in %.3f s" % (get_version(connection),
+                                                 time.time() - seconds)
+    print "%d jobs, version %d schema, WAL:" % (njobs, SCHEMA_VERSION)
+    benchmark(connection, PENDING, WAITING)
+
+    # Six months of nightly results of 20 urls at 2 speeds with 3 runs.
+    metrics = ["metric%d" % i for i in range(16)]
+    urls = ["http://url%d.example.com/" % i for i in range(20)]
+    speeds = ["Broadband", "ModernMobile"]
+    nnights = 180
+    seconds = time.time()
+    ntests = 0
+    for night in range(nnights):
+        for url in urls:
+            for speed in speeds:
+                ntests += 1
+                wpt_data = {"url": url, "location": "location:Firefox",
+                            "connectivity": speed}
+                wpt_runs = {}
+                for view in ("firstView", "repeatView"):
+                    wpt_data[view] = dict(
+                        [(metric, [random.randint(100, 5000)
+                                   for run in range(3)])
+                         for metric in metrics])
+                    wpt_runs[view] = dict(
+                        [(metric, [1, 2, 3]) for metric in metrics])
+                insert_results(connection, "test%d" % ntests, None, "nightly",
+                               "revision%d" % night, str(night), wpt_data,
+                               wpt_runs, int(start) + night * 86400)
+    seconds = time.time() - seconds
+    print "stored %d tests with %d values in %.3f s, %.3f ms per test" % (
+        ntests, ntests * len(metrics) * 6, seconds, seconds * 1000 / ntests)
+    def history():
+        return result_history(connection, urls[7], "location:Firefox",
+                              "ModernMobile", "firstView", "metric3")
+    seconds = min(timeit.repeat(history, repeat=3, number=5)) / 5
+    print "  %-26s %10.3f ms (%d values)" % ("series history", seconds * 1000,
+                                             len(history()))
+    connection.close()
+
+    for name in os.listdir(tempdirectory):
+        os.unlink(os.path.join(tempdirectory, name))
+    os.rmdir(tempdirectory)
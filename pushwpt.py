@@ -241,9 +241,14 @@ def postToWPTQueue(options):
                 'locations': options.locations}
 
     print options
-    controller = 'http://%s/wpt-controller/accept-jobs.wsgi' % host
-    print requests.post(controller, data=json.dumps(options))
-    return
+    controller = 'http://%s/wpt-controller/api/jobs' % host
+    response = requests.post(controller, data=json.dumps(options))
+    if response.status_code != 201:
+        print "ERROR: %s %s" % (response.status_code, response.content)
+        return None
+    job = json.loads(response.content)
+    print "Submitted job %s: %s" % (job['id'], response.headers['Location'])
+    return job['id']
 
 def main():
     parser=WptOptions()
@@ -0,0 +1,53 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+# wptcontroller wakes up wptmonitor through a unix datagram socket
+# when jobs are submitted or cancelled so that the monitor does not
+# have to wait for its next periodic check to notice them.
+
+import errno
+import os
+import select
+import socket
+
+class Wakeup(object):
+    """The monitor's end of the wakeup socket."""
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        self.socket.setblocking(0)
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds for a wakeup. Returns True if
+        woken up before the timeout."""
+        try:
+            readable = select.select([self.socket], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if not readable:
+            return False
+        # Several wakeups may have been sent while the monitor was busy.
+        while True:
+            try:
+                self.socket.recv(1024)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return True
+
+def wakeup(path):
+    """Wake up the monitor listening on path. Errors are ignored since
+    the monitor also checks for jobs periodically."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        client.sendto("wakeup", path)
+    except socket.error:
+        pass
+    finally:
+        client.close()
@@ -15,28 +15,48 @@ import os
 import sqlite3
 import urlparse
 
-from wsgiref.simple_server import make_server
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, make_server
 from cgi import parse_qs, escape
 
 from logging.handlers import TimedRotatingFileHandler
 from emailhandler import SMTPHandler
 from daemonize import Daemon
+from wakeup import wakeup
 from wptmonitor import JobMonitor
+from wpttemplate import Template
+import jobdb
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """Handle each request in its own thread so that a request which
+    is slow to send email or write to the database does not delay the
+    others."""
+    daemon_threads = True
 
 def application(environ, start_response):
-    email = ""
-    build = ""
-    label = ""
-    runs = ""
-    tcpdump = ""
-    video = ""
-    datazilla = ""
-    prescript = ""
-    postscript = ""
-    locations = []
-    speeds = []
-    urls = []
+    """Handle the request and close the request thread's database
+    connection once the response has been generated."""
+    try:
+        response = handle_request(environ, start_response)
+    except:
+        jm.close_thread_connection()
+        raise
+    if isinstance(response, list):
+        jm.close_thread_connection()
+        return response
+    return closing_response(response)
+
+def closing_response(response):
+    """Yield the chunks of the streamed response and then close the
+    request thread's database connection, which is also closed if the
+    server stops sending the response early."""
+    try:
+        for chunk in response:
+            yield chunk
+    finally:
+        jm.close_thread_connection()
 
+def handle_request(environ, start_response):
     if "REQUEST_METHOD" not in environ:
         status = "501 Not Implemented"
         response_body = "Missing REQUEST_METHOD: %s" % status
@@ -45,6 +65,14 @@ def application(environ, start_response):
         start_response(status, response_headers)
         return [str(response_body)]
 
+    # Apache proxies /wpt-controller to the root of the server, but
+    # accept the full path when the server is accessed directly.
+    path = environ.get("PATH_INFO", "")
+    if path.startswith("/wpt-controller"):
+        path = path[len("/wpt-controller"):]
+    if path == "/api/jobs" or path.startswith("/api/jobs/"):
+        return jobs_api(environ, start_response, path[len("/api/jobs"):])
+
     if not environ["REQUEST_METHOD"] in "GET,POST":
         status = "405 Method Not Allowed"
         response_headers = [("Allow", "GET,POST")]
@@ -52,167 +80,372 @@ def application(environ, start_response):
         return []
 
     if environ["REQUEST_METHOD"] == "POST":
-        # the environment variable CONTENT_LENGTH may be empty or missing
-        try:
-            request_body_size = int(environ.get("CONTENT_LENGTH", 0))
-        except (ValueError):
-            request_body_size = 0
-
-        # When the method is POST the query string will be sent
-        # in the HTTP request body which is passed by the WSGI server
-        # in the file like wsgi.input environment variable.
-        request_body = environ["wsgi.input"].read(request_body_size)
-        try:
-            d = json.loads(request_body)
-        except:
-            d = parse_qs(request_body)
-
-        email = d.get("email", [""])[0]
-        build = d.get("build", [""])[0]
-        # bc: Force the build url to be over https to work around proxy errors
-        # with http. See wptmonitor.get_proxy_info.
-        build_parts = [build_part for build_part in urlparse.urlparse(build)]
-        if build_parts[0].lower() == 'http':
-            build_parts[0] = 'https'
-            build = urlparse.urlunparse(build_parts)
-        label = d.get("label", [""])[0]
-        runs = d.get("runs", [""])[0]
-        tcpdump = d.get("tcpdump", [""])[0]
-        video = d.get("video", [""])[0]
-        datazilla = d.get("datazilla", [""])[0]
-        url = d.get("url", [""])[0]
-        prescript = d.get("prescript", [""])[0]
-        postscript = d.get("postscript", [""])[0]
-        locations = d.get("locations", [])
-        speeds = d.get("speeds", [])
-        urls = d.get("urls", [])
-        canceljobs = d.get("canceljobs", [])
-        if url:
-            urls.append(url)
+        d = read_request_fields(environ)
+        job = parse_job(d)
+        canceljobs = field_values(d, "canceljobs")
 
-        # Always escape user input to avoid script injection
-        email = escape(email.strip())
-        build = escape(build.strip())
-        label = escape(label.strip())
-        runs = escape(runs.strip())
-        tcpdump = escape(tcpdump.strip())
-        video = escape(video.strip())
-        datazilla = escape(datazilla.strip())
-        prescript = escape(prescript.strip())
-        postscript = escape(postscript.strip())
-        locations = [escape(location.strip()) for location in locations]
-        speeds = [escape(speed.strip()) for speed in speeds]
-        urls = [escape(url.strip()) for url in urls]
-        canceljobs = [escape(canceljob.strip()) for canceljob in canceljobs]
-
-        for canceljob in canceljobs:
-            jm.purge_job(int(canceljob))
-
-        if email and build and runs and locations and speeds and urls:
-            jm.create_job(email, build, label, runs, tcpdump,
-                          video, datazilla, prescript, postscript,
-                          locations, speeds, urls, [])
+        # Requests are handled in separate threads which share jm.job.
+        if canceljobs:
+            with jm.job_lock:
+                jm.purge_jobs([int(canceljob) for canceljob in canceljobs])
+            wakeup(jm.wakeup_socket)
+
+        if not missing_job_fields(job):
+            submit_job(job)
 
         status = "302 Found"
         response_headers = [("Location", "/wpt-controller")]
         start_response(status, response_headers)
         return []
 
-    currentteststable = ""
-
+    query = parse_qs(environ.get("QUERY_STRING", ""))
+    try:
+        page = max(1, int(query.get("page", ["1"])[0]))
+    except ValueError:
+        page = 1
+
+    # The page is streamed as it is rendered without a Content-Length
+    # so that the form is sent before the jobs are queried.
+    start_response("200 OK", [("Content-Type", "text/html")])
+    return page_template.generate(
+        {"currenttests": generate_current_tests(page)})
+
+def read_request_fields(environ):
+    """Return the dict of the fields of the POST request's body which
+    may be either JSON or form encoded."""
+    # the environment variable CONTENT_LENGTH may be empty or missing
+    try:
+        request_body_size = int(environ.get("CONTENT_LENGTH", 0))
+    except (ValueError):
+        request_body_size = 0
+
+    # When the method is POST the query string will be sent
+    # in the HTTP request body which is passed by the WSGI server
+    # in the file like wsgi.input environment variable.
+    request_body = environ["wsgi.input"].read(request_body_size)
     try:
-        jm.cursor.execute("select * from jobs")
-        jobrows = jm.cursor.fetchall()
+        d = json.loads(request_body)
+        if not isinstance(d, dict):
+            raise ValueError("not a JSON object")
+    except:
+        d = parse_qs(request_body)
+    return d
+
+def field_values(d, name):
+    """Return the list of the values of the field name. A JSON request
+    may give a single value rather than a list and true or false for
+    a checkbox."""
+    values = d.get(name, [])
+    if not isinstance(values, list):
+        values = [values]
+    texts = []
+    for value in values:
+        if value is True:
+            value = "on"
+        elif value is False or value is None:
+            value = ""
+        elif not isinstance(value, basestring):
+            value = str(value)
+        # Always escape user input to avoid script injection
+        texts.append(escape(value.strip()))
+    return texts
+
+def field_value(d, name):
+    values = field_values(d, name)
+    if not values:
+        return ""
+    return values[0]
+
+def parse_job(d):
+    """Return the dict of the job's fields given by the request
+    fields d."""
+    build = field_value(d, "build")
+    # bc: Force the build url to be over https to work around proxy errors
+    # with http. See httppool.get_proxy_info.
+    build_parts = [build_part for build_part in urlparse.urlparse(build)]
+    if build_parts[0].lower() == 'http':
+        build_parts[0] = 'https'
+        build = urlparse.urlunparse(build_parts)
+    urls = field_values(d, "urls")
+    url = field_value(d, "url")
+    if url:
+        urls.append(url)
+    return {"email": field_value(d, "email"),
+            "build": build,
+            "label": field_value(d, "label"),
+            "runs": field_value(d, "runs"),
+            "tcpdump": field_value(d, "tcpdump"),
+            "video": field_value(d, "video"),
+            "datazilla": field_value(d, "datazilla"),
+            "immediate": field_value(d, "immediate"),
+            "prescript": field_value(d, "prescript"),
+            "postscript": field_value(d, "postscript"),
+            "locations": field_values(d, "locations"),
+            "speeds": field_values(d, "speeds"),
+            "urls": urls}
+
+def missing_job_fields(job):
+    return [name for name in ("email", "build", "runs", "locations",
+                              "speeds", "urls")
+            if not job[name]]
+
+def submit_job(job):
+    """Create the job, wake up the monitor and return the job's id."""
+    # Requests are handled in separate threads which share jm.job.
+    with jm.job_lock:
+        jobid = jm.create_job(job["email"], job["build"], job["label"],
+                              job["runs"], job["tcpdump"], job["video"],
+                              job["datazilla"], job["prescript"],
+                              job["postscript"], job["locations"],
+                              job["speeds"], job["urls"], [],
+                              bool(job["immediate"]))
+    wakeup(jm.wakeup_socket)
+    return jobid
+
+def jobs_api(environ, start_response, path):
+    """The JSON API to the jobs at /wpt-controller/api/jobs.
+
+    GET /api/jobs lists the jobs, optionally filtered by the status,
+    email and label query parameters, and POST /api/jobs submits a job
+    with the same fields as the form. GET /api/jobs/<id> returns a job
+    and DELETE /api/jobs/<id> cancels it unless it is running.
+
+    Every GET response has the jobs table's change counter as its
+    ETag, so a client polling with If-None-Match gets 304 Not Modified
+    until a job changes.
+    """
+    method = environ["REQUEST_METHOD"]
+    try:
+        if path in ("", "/"):
+            if method == "GET":
+                return api_list_jobs(environ, start_response)
+            if method == "POST":
+                return api_submit_job(environ, start_response)
+            return api_response(start_response, "405 Method Not Allowed",
+                                {"error": "method not allowed"},
+                                [("Allow", "GET,POST")])
+        try:
+            jobid = int(path.strip("/"))
+        except ValueError:
+            return api_response(start_response, "404 Not Found",
+                                {"error": "not found"})
+        if method == "GET":
+            return api_get_job(environ, start_response, jobid)
+        if method == "DELETE":
+            return api_cancel_job(start_response, jobid)
+        return api_response(start_response, "405 Method Not Allowed",
+                            {"error": "method not allowed"},
+                            [("Allow", "GET,DELETE")])
+    except sqlite3.Error:
+        jm.notify_admin_exception("Error in jobs API")
+        return api_response(start_response, "500 Internal Server Error",
+                            {"error": "database error"})
+
+def api_response(start_response, status, body, headers=[]):
+    response_body = json.dumps(body)
+    start_response(status,
+                   [("Content-Type", "application/json"),
+                    ("Content-Length", str(len(response_body)))] + headers)
+    return [response_body]
+
+def api_etag_headers(environ):
+    """Return the ETag headers for the current state of the jobs and
+    whether they match the request's If-None-Match header."""
+    # The counter is read before the jobs, so a change made in between
+    # only costs the client an extra request.
+    etag = '"%d"' % jobdb.get_jobs_changes(jm.connection)
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH", "")
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    matches = "*" in tags or etag in tags or "W/" + etag in tags
+    return ([("ETag", etag), ("Cache-Control", "no-cache")], matches)
+
+def job_json(job):
+    (jobid, email, build, label, runs, tcpdump, video, datazilla,
+     prescript, postscript, status, started, timestamp, immediate,
+     locations, speeds, urls) = job
+    return {"id": jobid,
+            "email": email,
+            "build": build,
+            "label": label,
+            "runs": runs,
+            "tcpdump": bool(tcpdump),
+            "video": bool(video),
+            "datazilla": bool(datazilla),
+            "immediate": bool(immediate),
+            "prescript": prescript,
+            "postscript": postscript,
+            "status": jobdb.status_name(status),
+            "started": jobdb.format_time(started),
+            "timestamp": jobdb.format_time(timestamp),
+            "locations": locations,
+            "speeds": speeds,
+            "urls": urls}
+
+def api_list_jobs(environ, start_response):
+    query = parse_qs(environ.get("QUERY_STRING", ""))
+    status = field_value(query, "status") or None
+    if status is not None:
+        codes = [code for code in jobdb.STATUS_NAMES
+                 if jobdb.STATUS_NAMES[code] == status]
+        if not codes:
+            return api_response(start_response, "400 Bad Request",
+                                {"error": "unknown status %s" % status})
+        status = codes[0]
+    email = field_value(query, "email") or None
+    label = field_value(query, "label") or None
+    try:
+        limit = int(field_value(query, "limit") or jm.jobs_per_page)
+        offset = int(field_value(query, "offset") or 0)
+    except ValueError:
+        return api_response(start_response, "400 Bad Request",
+                            {"error": "limit and offset must be integers"})
+    limit = min(max(1, limit), 1000)
+    offset = max(0, offset)
+
+    (headers, matches) = api_etag_headers(environ)
+    if matches:
+        start_response("304 Not Modified", headers)
+        return []
+    total = jobdb.count_jobs(jm.connection, status, email, label)
+    jobs = jobdb.list_jobs(jm.connection, limit, offset, status, email, label)
+    return api_response(start_response, "200 OK",
+                        {"total": total,
+                         "limit": limit,
+                         "offset": offset,
+                         "jobs": [job_json(job) for job in jobs]},
+                        headers)
+
+def api_get_job(environ, start_response, jobid):
+    (headers, matches) = api_etag_headers(environ)
+    if matches:
+        start_response("304 Not Modified", headers)
+        return []
+    job = jobdb.get_job(jm.connection, jobid)
+    if not job:
+        return api_response(start_response, "404 Not Found",
+                            {"error": "job %d not found" % jobid}, headers)
+    return api_response(start_response, "200 OK", job_json(job), headers)
+
+def api_submit_job(environ, start_response):
+    job = parse_job(read_request_fields(environ))
+    missing = missing_job_fields(job)
+    if missing:
+        return api_response(start_response, "400 Bad Request",
+                            {"error": "missing %s" % ", ".join(missing)})
+    try:
+        if int(job["runs"]) < 1:
+            raise ValueError
+    except ValueError:
+        return api_response(start_response, "400 Bad Request",
+                            {"error": "runs must be a positive integer"})
+    try:
+        jobid = submit_job(job)
+    except Exception:
+        # create_job has already notified the admins and the user.
+        return api_response(start_response, "500 Internal Server Error",
+                            {"error": "error creating job"})
+    return api_response(start_response, "201 Created",
+                        job_json(jobdb.get_job(jm.connection, jobid)),
+                        [("Location", "/wpt-controller/api/jobs/%d" % jobid)])
+
+def api_cancel_job(start_response, jobid):
+    with jm.job_lock:
+        job = jobdb.get_job(jm.connection, jobid)
+        if not job:
+            return api_response(start_response, "404 Not Found",
+                                {"error": "job %d not found" % jobid})
+        if job[10] == jobdb.RUNNING:
+            return api_response(start_response, "409 Conflict",
+                                {"error": "job %d is running" % jobid})
+        jm.purge_jobs([jobid])
+    wakeup(jm.wakeup_socket)
+    start_response("204 No Content", [])
+    return []
+
+jobs_table_head = Template(
+    "<table><caption>Current Tests (%(njobs)s)</caption>"
+    "<tr>"
+    "<th>cancel</th>"
+    "<th>job id</th><th>user email</th><th>build</th>"
+    "<th>label</th><th>runs</th><th>tcpdump</th>"
+    "<th>video</th><th>datazilla</th><th>prescript</th><th>postscript</th><th>status</th><th>started</th>"
+    "<th>timestamp</th>"
+    "<th>locations</th>"
+    "<th>speeds</th>"
+    "<th>urls</th>"
+    "</tr>")
+
+# One row per job. The job's urls are listed in an expandable details
+# element.
+jobs_table_row = Template(
+    "<tr>"
+    "<td>%(cancel)s</td>"
+    "<td>%(jobid)s</td><td>%(email)s</td><td>%(build)s</td>"
+    "<td>%(label)s</td><td>%(runs)s</td><td>%(tcpdump)s</td>"
+    "<td>%(video)s</td><td>%(datazilla)s</td><td>%(prescript)s</td><td>%(postscript)s</td><td>%(status)s</td><td>%(started)s</td>"
+    "<td>%(timestamp)s</td>"
+    "<td>%(locations)s</td>"
+    "<td>%(speeds)s</td>"
+    "<td><details><summary>%(nurls)s url%(plural)s</summary>%(urls)s</details></td>"
+    "</tr>")
+
+def generate_current_tests(page):
+    """Yield the table of the jobs on the page followed by the links
+    to the previous and next pages."""
+    try:
+        njobs = jobdb.count_jobs(jm.connection)
+        npages = max(1, (njobs + jm.jobs_per_page - 1) / jm.jobs_per_page)
+        page = min(page, npages)
+        jobs = jobdb.list_jobs(jm.connection, jm.jobs_per_page,
+                               (page - 1) * jm.jobs_per_page)
     except sqlite3.OperationalError:
         jm.notify_admin_exception("Error displaying current jobs")
         raise
 
-    if jobrows:
-        currentteststable = (
-            "<table><caption>Current Tests</caption>" +
-            "<tr>" +
-            "<th>cancel</th>" +
-            "<th>job id</th><th>user email</th><th>build</th>" +
-            "<th>label</th><th>runs</th><th>tcpdump</th>" +
-            "<th>video</th><th>datazilla</th><th>prescript</th><th>postscript</th><th>status</th><th>started</th>" +
-            "<th>timestamp</th>" +
-            "<th>location</th>" +
-            "<th>speed</th>" +
-            "<th>url</th>" +
-            "</tr>")
-
-    for jobrow in jobrows:
-        (jobid, email, build, label, runs, tcpdump, video, datazilla,
-         prescript, postsript,
-         status, started, timestamp) = jobrow
-        jm.set_job(jobid, email, build, label, runs, tcpdump, video, datazilla,
-                   prescript, postscript, status, started, timestamp)
-        try:
-            jm.cursor.execute(
-                "select * from locations where jobid=:jobid",
-                {"jobid": jobid})
-            locationrows = jm.cursor.fetchall()
-        except sqlite3.OperationalError:
-            jm.notify_admin_exception("Error displaying current jobs",
-                                      "SQLError selecting locations for job %s." %
-                                      jobid)
-            raise
-
-        try:
-            jm.cursor.execute(
-                "select * from speeds where jobid=:jobid",
-                {"jobid": jobid})
-            speedrows = jm.cursor.fetchall()
-        except sqlite3.OperationalError:
-            jm.notify_admin_exception("Error displaying current jobs",
-                                      "SQLError selecting speeds for job %s." %
-                                      jobid)
-            raise
+    if not jobs:
+        return
 
-        try:
-            jm.cursor.execute(
-                "select * from urls where jobid=:jobid",
-                {"jobid": jobid})
-            urlrows = jm.cursor.fetchall()
-        except sqlite3.OperationalError:
-            jm.notify_admin_exception("Error displaying current jobs",
-                                      "SQLError selecting urls for job %s." %
-                                      jobid)
-            raise
-
-        showcanceljob = False if status == 'running' else True
-        for locationrow in locationrows:
-            for speedrow in speedrows:
-                for urlrow in urlrows:
-                    args = [jobrow[0]]
-                    args.extend(jobrow)
-                    args.append(locationrow[1])
-                    args.append(speedrow[1])
-                    args.append(urlrow[1])
-
-                    currentteststable += (
-                        ("<tr>" +
-                         ("<td><input name='canceljobs' value='%s' type='checkbox'></td>"
-                          if showcanceljob else "<td>&nbsp;<!-- %s --></td>") +
-                         "<td>%s</td><td>%s</td><td>%s</td>" +
-                         "<td>%s</td><td>%s</td><td>%s</td>" +
-                         "<td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td>" +
-                         "<td>%s</td>" +
-                         "<td>%s</td>" +
-                         "<td>%s</td>" +
-                         "<td>%s</td>" +
-                         "</tr>") % tuple(args))
-                    showcanceljob = False
-
-    if jobrows:
-        currentteststable += "</table>"
-
-    response_body = html % currentteststable
-    status = "200 OK"
-    response_headers = [("Content-Type", "text/html"),
-                        ("Content-Length", str(len(response_body)))]
-    start_response(status, response_headers)
-    return [str(response_body)]
+    yield jobs_table_head.render({"njobs": njobs})
+    for job in jobs:
+        (jobid, email, build, label, runs, tcpdump, video, datazilla,
+         prescript, postscript, status, started, timestamp, immediate,
+         locations, speeds, urls) = job
+        if status != jobdb.RUNNING:
+            cancel = ("<input name='canceljobs' value='%s' type='checkbox'>" %
+                      jobid)
+        else:
+            cancel = "&nbsp;"
+        yield jobs_table_row.render({
+            "cancel": cancel,
+            "jobid": jobid,
+            "email": email,
+            "build": build,
+            "label": label,
+            "runs": runs,
+            "tcpdump": tcpdump,
+            "video": video,
+            "datazilla": datazilla,
+            "prescript": prescript,
+            "postscript": postscript,
+            "status": jobdb.status_name(status),
+            "started": jobdb.format_time(started),
+            "timestamp": jobdb.format_time(timestamp),
+            "locations": "<br>".join(locations),
+            "speeds": "<br>".join(speeds),
+            "nurls": len(urls),
+            "plural": "s" if len(urls) != 1 else "",
+            "urls": "<br>".join(urls)})
+    yield "</table>"
+
+    if npages > 1:
+        links = ["<p>"]
+        if page > 1:
+            links.append("<a href='?page=%d'>previous</a> " % (page - 1))
+        links.append("page %d of %d" % (page, npages))
+        if page < npages:
+            links.append(" <a href='?page=%d'>next</a>" % (page + 1))
+        links.append("</p>")
+        yield "".join(links)
 
 if __name__ == "__main__":
 
@@ -265,7 +498,7 @@ if __name__ == "__main__":
 
     (options, args) = parser.parse_args()
 
-    jm = JobMonitor(options, createdb=True)
+    jm = JobMonitor(options, createdb=True, controller=True)
 
     html = """
 <!DOCTYPE html>
@@ -303,6 +536,11 @@ if __name__ == "__main__":
           <label>Submit to datazilla: <input type="checkbox" name="datazilla">
           </label>
         </p>
+        <p>
+          <label>Email each step of the job as it happens rather than
+          a summary when it completes: <input type="checkbox" name="immediate">
+          </label>
+        </p>
         <p>
           <!--
             These are the predefined connection speeds in webpagetest's
@@ -357,7 +595,7 @@ if __name__ == "__main__":
           <label for="postscript">Post Script:</label> Executed after page load.
         </p>
         <textarea name="postscript" cols="80" rows="6"></textarea>
-        %s
+        %(currenttests)s
         <p>
           <input type="submit" value="Submit">
         </p>
@@ -366,11 +604,16 @@ if __name__ == "__main__":
   </body>
 </html>
 """
+    # The static parts of the page are compiled once into byte strings.
+    page_template = Template(html)
+
     try:
-        httpd = make_server("localhost", jm.port, application)
+        httpd = make_server("localhost", jm.port, application,
+                            server_class=ThreadingWSGIServer)
         httpd.serve_forever()
     except:
         jm.notify_admin_exception("Error in wsgi server",
                                   "wptcontroller has terminated due to an uncaught exception.")
+        jm.notify_admin_summaries(force=True)
 
 
@@ -4,56 +4,53 @@
 # http://mozilla.org/MPL/2.0/.
 
 import ConfigParser
+import copy
 import datetime
-import httplib2
 import json
 import logging
-#import md5
 import os
 import os.path
 import random
 import re
-import shutil
 import sqlite3
-import subprocess
-import tempfile
+import sys
+import threading
 import time
 import urllib
 
+import httplib2
+
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from dzclient import DatazillaRequest, DatazillaResult
 
-import BeautifulSoup
-
 from logging.handlers import TimedRotatingFileHandler
-from emailhandler import SMTPHandler
+from emailhandler import MailWorker, Outbox, SMTPHandler, SMTPSession
 from daemonize import Daemon
-
-def get_proxy_info(scheme):
-    """ Work around http://code.google.com/p/httplib2/issues/detail?id=228
-    Squid proxies are typically configured to prevent socket connect on http
-    ports. get_proxy_info forces the proxy to use socks.PROXY_TYPE_HTTP_NO_TUNNEL
-    for http to work around the issue.
-    bc: The current squid proxy will still fail with a status 400 Invalid Request
-    'x-squid-error': 'ERR_INVALID_URL 0.
-    """
-    if hasattr(httplib2, 'proxy_info_from_environment'):
-        # httplib2 0.8
-        proxy_info = httplib2.proxy_info_from_environment()
-    elif hasattr(httplib2.ProxyInfo, 'from_environment'):
-        # httplib2 0.7.x
-        proxy_info = httplib2.ProxyInfo.from_environment()
-    else:
-        proxy_info = None
-    if (proxy_info and scheme == 'http' and
-        hasattr(httplib2.socks, 'PROXY_TYPE_HTTP_NO_TUNNEL')):
-        proxy_info.proxy_type = httplib2.socks.PROXY_TYPE_HTTP_NO_TUNNEL
-    return proxy_info
+from alertthrottle import AlertThrottle, fingerprint
+from buildcache import BuildCache
+from buildprefetch import BuildPrefetch
+from httppool import HttpPool
+from wakeup import Wakeup, wakeup
+from wptresult import WPT_METRIC_KEYS, TeeReader, extract_result
+from wptstats import PERCENTILES, load_statistics
+import wptregress
+import jobdb
+
+re_href = re.compile(r"""href\s*=\s*["']([^"']*)["']""", re.IGNORECASE)
+re_builds = re.compile(r"firefox-([0-9]+(?:\.[0-9]+)*)(?:([ab])([0-9]+))?\..*\.win32\.installer\.exe$")
+
+def build_version_key(match):
+    """Return a sortable key for the version of a re_builds match where
+    alphas sort before betas which sort before releases."""
+    numbers = tuple([int(number) for number in match.group(1).split(".")])
+    stage = {"a": 0, "b": 1, None: 2}[match.group(2)]
+    return (numbers, stage, int(match.group(3) or 0))
 
 class Job(object):
     def __init__(self, jobmonitor, jobid, email, build, label, runs, tcpdump,
                  video, datazilla, prescript, postscript, status, started,
-                 timestamp):
+                 timestamp, immediate=False):
         self.jm = jobmonitor
         self.id = jobid
         self.email = email
@@ -73,9 +70,10 @@ class Job(object):
             self.locations = None
             self.speeds = None
             self.urls, self.scripts = None, None
-        self.status = status
+        self.status = jobdb.status_name(status)
         self.started = started
         self.timestamp = timestamp
+        self.immediate = bool(immediate)
 
     # Don't capture exceptions in get_locations, get_speeds or get_urls.
     # We will catch any exceptions thrown here and clean up the job from
@@ -111,7 +109,7 @@ class Job(object):
         return urls, scripts
 
 class JobMonitor(Daemon):
-    def __init__(self, options, createdb=False):
+    def __init__(self, options, createdb=False, controller=False):
 
         super(JobMonitor, self).__init__(options)
 
@@ -131,15 +129,128 @@ class JobMonitor(Daemon):
             self.port = config.getint("server", "port")
         except ConfigParser.Error:
             self.port = 8051
+        try:
+            self.build_check_max_minutes = config.getint(
+                "server", "build_check_max_minutes")
+        except ConfigParser.Error:
+            self.build_check_max_minutes = 60
+        try:
+            self.build_deadline_hours = config.getint("server",
+                                                      "build_deadline_hours")
+        except ConfigParser.Error:
+            self.build_deadline_hours = 24
+        try:
+            self.submit_workers = config.getint("server", "submit_workers")
+        except ConfigParser.Error:
+            self.submit_workers = 4
+        try:
+            self.poll_min_time = config.getint("server", "poll_min_time")
+        except ConfigParser.Error:
+            self.poll_min_time = 10
+        self.poll_latency = {}
+        try:
+            self.agent_ready_timeout = config.getint("server",
+                                                     "agent_ready_timeout")
+        except ConfigParser.Error:
+            self.agent_ready_timeout = 300
+        try:
+            self.agent_fallback_delay = config.getint("server",
+                                                      "agent_fallback_delay")
+        except ConfigParser.Error:
+            self.agent_fallback_delay = 120
+        try:
+            self.jobs_per_page = config.getint("server", "jobs_per_page")
+        except ConfigParser.Error:
+            self.jobs_per_page = 50
+        try:
+            self.database_busy_timeout = config.getint(
+                "server", "database_busy_timeout")
+        except ConfigParser.Error:
+            self.database_busy_timeout = 30
+        # Both wptcontroller and wptmonitor use the same database, so
+        # by default the wakeup socket is kept next to it.
+        try:
+            self.wakeup_socket = config.get("server", "wakeup_socket")
+        except ConfigParser.Error:
+            self.wakeup_socket = os.path.join(
+                os.path.dirname(os.path.abspath(self.database)),
+                "wptmonitor.sock")
         self.api_key = config.get("server", "api_key")
+        try:
+            http_max_connections = config.getint("http", "max_connections")
+        except ConfigParser.Error:
+            http_max_connections = self.submit_workers
+        try:
+            http_timeout = config.getint("http", "timeout")
+        except ConfigParser.Error:
+            http_timeout = None
+        try:
+            http_chunk_size = config.getint("http", "download_chunk_size")
+        except ConfigParser.Error:
+            http_chunk_size = 4194304
+        try:
+            http_download_workers = config.getint("http", "download_workers")
+        except ConfigParser.Error:
+            http_download_workers = 1
+        try:
+            http_download_attempts = config.getint("http", "download_attempts")
+        except ConfigParser.Error:
+            http_download_attempts = 3
+        # wptcontroller only serves the job pages and the jobs API and
+        # does not download anything.
+        self.http = None
+        if not controller:
+            self.http = HttpPool(max_connections=http_max_connections,
+                                 timeout=http_timeout,
+                                 chunk_size=http_chunk_size,
+                                 download_workers=http_download_workers,
+                                 download_attempts=http_download_attempts)
         self.firefoxpath = config.get("server", "firefoxpath")
         self.firefoxdatpath = config.get("server", "firefoxdatpath")
+        # Prefetched builds are staged next to firefoxpath so that
+        # they can be renamed into place.
+        try:
+            self.stagingdir = config.get("server", "stagingdir")
+        except ConfigParser.Error:
+            self.stagingdir = os.path.dirname(self.firefoxpath)
+        self.prefetches = {}
+        # ETag and Last-Modified headers of available builds.
+        self.build_validators = {}
+        # ETag, Last-Modified and hrefs of build directory listings.
+        self.listing_cache = {}
+        # Time of the next check and current check interval in minutes
+        # of the builds of waiting jobs.
+        self.build_checks = {}
         self.build_name = None
         self.build_version = None
         self.build_id = None
         self.build_branch = None
         self.build_revision = None
 
+        # Locations in the same isolation group are tested one at a
+        # time while different groups are tested concurrently. Each
+        # option in the isolation_groups section names a group and
+        # lists its locations or machine names. Locations which are not
+        # listed share the default group.
+        self.isolation_groups = {}
+        try:
+            for group_name, group_locations in config.items("isolation_groups"):
+                for group_location in group_locations.split(","):
+                    self.isolation_groups[group_location.strip()] = group_name
+        except ConfigParser.Error:
+            pass
+        # Serialize the notifications since the handlers' addresses and
+        # subjects are set before each message is logged.
+        self.notify_lock = threading.RLock()
+        # Notifications of each job to be sent together when the job
+        # completes unless the job asked for immediate notifications.
+        self.digests = {}
+        # Serialize the changes to self.job made by wptcontroller's
+        # request threads.
+        self.job_lock = threading.RLock()
+        # Each thread has its own database connection and cursor.
+        self.thread_local = threading.local()
+
         self.default_locations = config.get("defaults", "locations").split(",")
         self.default_urls = config.get("defaults", "urls").split(",")
 
@@ -148,10 +259,24 @@ class JobMonitor(Daemon):
         self.mail_username = config.get("mail", "username")
         self.mail_password = config.get("mail", "password")
         self.mail_host = config.get("mail", "mailhost")
+        try:
+            self.mail_max_attempts = config.getint("mail", "max_attempts")
+        except ConfigParser.Error:
+            self.mail_max_attempts = 10
+        try:
+            self.mail_idle_timeout = config.getint("mail", "idle_timeout")
+        except ConfigParser.Error:
+            self.mail_idle_timeout = 60
 
         self.oauth_key = config.get("datazilla", "oauth_consumer_key")
         self.oauth_secret = config.get("datazilla", "oauth_consumer_secret")
 
+        try:
+            admin_alert_window = config.getint("admin", "alert_window")
+        except ConfigParser.Error:
+            admin_alert_window = 3600
+        self.admin_alerts = AlertThrottle(admin_alert_window)
+
         self.admin_loglevel = logging.DEBUG
         try:
             self.admin_loglevel = getattr(logging,
@@ -204,6 +329,47 @@ class JobMonitor(Daemon):
                                    secure=())
         self.userlogger.addHandler(self.userhandler)
 
+        try:
+            build_cache_dir = config.get("server", "build_cache_dir")
+        except ConfigParser.Error:
+            build_cache_dir = os.path.join(self.stagingdir, "buildcache")
+        try:
+            build_cache_size = config.getint("server", "build_cache_size")
+        except ConfigParser.Error:
+            build_cache_size = 2048
+        self.build_cache = None
+        if not controller:
+            self.build_cache = BuildCache(build_cache_dir,
+                                          build_cache_size * 1024 * 1024,
+                                          self.logger)
+
+        try:
+            self.baseline_tests = config.getint("regression",
+                                                "baseline_tests")
+        except ConfigParser.Error:
+            self.baseline_tests = 20
+        try:
+            self.baseline_min_tests = config.getint("regression",
+                                                    "baseline_min_tests")
+        except ConfigParser.Error:
+            self.baseline_min_tests = 5
+        try:
+            self.regression_threshold = config.getfloat("regression",
+                                                        "threshold")
+        except ConfigParser.Error:
+            self.regression_threshold = 3.5
+        try:
+            self.regression_min_change = config.getfloat("regression",
+                                                         "min_change")
+        except ConfigParser.Error:
+            self.regression_min_change = 5.0
+        try:
+            self.regression_report_dir = config.get("regression",
+                                                    "report_dir")
+        except ConfigParser.Error:
+            self.regression_report_dir = os.path.dirname(
+                os.path.abspath(self.logfile))
+
         self.automatic_jobs = []
         job_names = []
         try:
@@ -225,6 +391,11 @@ class JobMonitor(Daemon):
             automatic_job["tcpdump"] = config.get(job_name, "tcpdump")
             automatic_job["video"] = config.get(job_name, "video")
             automatic_job["datazilla"] = config.get(job_name, "datazilla")
+            try:
+                automatic_job["immediate"] = config.getboolean(job_name,
+                                                               "immediate")
+            except ConfigParser.Error:
+                automatic_job["immediate"] = False
             automatic_job["hour"] = config.getint(job_name, "hour")
             # If the current hour before the scheduled hour for
             # the job, force its submission today. Otherwise, wait until
@@ -233,78 +404,79 @@ class JobMonitor(Daemon):
             if automatic_job["datetime"].hour <= automatic_job["hour"]:
                 automatic_job["datetime"] -= datetime.timedelta(days=1)
 
-        if os.path.exists(self.database):
-            try:
-                self.connection = sqlite3.connect(self.database)
-                self.connection.execute("PRAGMA foreign_keys = ON;")
-                self.cursor = self.connection.cursor()
-            except sqlite3.OperationalError:
-                self.notify_admin_logger("Failed to start").exception(
-                    "Could not get database connection " +
-                    "to %s" % self.database)
-                exit(2)
-        elif not createdb:
+        if not os.path.exists(self.database) and not createdb:
                 self.notify_admin_logger("Failed to start").error(
                     "database file %s does not exist" %
                     self.database)
                 exit(2)
+        try:
+            version = jobdb.migrate(self.connection)
+            if version != jobdb.SCHEMA_VERSION:
+                self.logger.info("upgraded database %s from schema version "
+                                 "%d to %d" % (self.database, version,
+                                               jobdb.SCHEMA_VERSION))
+        except sqlite3.Error:
+            self.notify_admin_logger("Failed to start").exception(
+                "SQLError opening or upgrading database %s" % self.database)
+            exit(2)
+
+        # Now that the database has an outbox, notifications are queued
+        # there and sent in the background by wptmonitor's worker.
+        # wptcontroller wakes up wptmonitor to send its notifications.
+        if controller:
+            self.mail_worker = None
+            outbox = Outbox(lambda: self.connection,
+                            lambda: wakeup(self.wakeup_socket))
         else:
-            try:
-                self.connection = sqlite3.connect(options.database)
-                self.connection.execute("PRAGMA foreign_keys = ON;")
-                self.cursor = self.connection.cursor()
-                self.cursor.execute("create table jobs ("
-                                    "id integer primary key autoincrement, "
-                                    "email text, "
-                                    "build text, "
-                                    "label text, "
-                                    "runs text, "
-                                    "tcpdump text, "
-                                    "video text, "
-                                    "datazilla text, "
-                                    "prescript text, "
-                                    "postscript text, "
-                                    "status text, "
-                                    "started text, "
-                                    "timestamp text"
-                                    ")"
-                                    )
-                self.connection.commit()
-                self.cursor.execute("create table locations ("
-                                    "id integer primary key autoincrement, "
-                                    "location text, "
-                                    "jobid references jobs(id)"
-                                    ")"
-                                    )
-                self.connection.commit()
-                self.cursor.execute("create table speeds ("
-                                    "id integer primary key autoincrement, "
-                                    "speed text, "
-                                    "jobid references jobs(id)"
-                                    ")"
-                                    )
-                self.connection.commit()
-                self.cursor.execute("create table urls ("
-                                    "id integer primary key autoincrement, "
-                                    "url text, "
-                                    "script text, "
-                                    "jobid references jobs(id)"
-                                    ")"
-                                    )
-                self.connection.commit()
-            except sqlite3.OperationalError:
-                self.notify_admin_logger("Failed to start").exception(
-                    "SQLError creating schema in " +
-                    "database %s" % options.database)
-                exit(2)
+            self.mail_worker = MailWorker(
+                self.database, self.database_busy_timeout,
+                SMTPSession(self.emailhandler.mailhost,
+                            self.emailhandler.mailport,
+                            self.mail_username, self.mail_password, ()),
+                self.logger, max_attempts=self.mail_max_attempts,
+                idle_timeout=self.mail_idle_timeout)
+            self.mail_worker.start()
+            outbox = self.mail_worker
+        self.emailhandler.worker = outbox
+        self.userhandler.worker = outbox
+
+    @property
+    def connection(self):
+        """The current thread's database connection."""
+        connection = getattr(self.thread_local, "connection", None)
+        if connection is None:
+            connection = jobdb.connect(self.database,
+                                       self.database_busy_timeout)
+            self.thread_local.connection = connection
+        return connection
+
+    @property
+    def cursor(self):
+        """The current thread's database cursor."""
+        cursor = getattr(self.thread_local, "cursor", None)
+        if cursor is None:
+            cursor = self.thread_local.cursor = self.connection.cursor()
+        return cursor
+
+    def close_thread_connection(self):
+        """Close the current thread's database connection if it has
+        one. Threads other than the main thread call this when they
+        are done so that their connections do not hold read snapshots
+        of the database open.
+        """
+        connection = getattr(self.thread_local, "connection", None)
+        if connection is not None:
+            connection.close()
+        self.thread_local.connection = None
+        self.thread_local.cursor = None
 
     def set_job(self, jobid, email, build, label, runs, tcpdump,
                 video, datazilla, prescript, postscript, status, started,
-                timestamp):
+                timestamp, immediate=False):
         try:
             self.job = Job(self, jobid, email, build, label, runs, tcpdump,
                            video, datazilla, prescript, postscript, status,
-                           started, timestamp)
+                           started, timestamp, immediate)
         except:
             self.notify_admin_exception("Error setting job")
             self.notify_user_exception(self.job.email,
@@ -313,9 +485,10 @@ class JobMonitor(Daemon):
 
     def create_job(self, email, build, label, runs, tcpdump,
                    video, datazilla, prescript, postscript,
-                   locations, speeds, urls, scripts):
+                   locations, speeds, urls, scripts, immediate=False):
+        """Insert a waiting job and return its id."""
         self.set_job(None, email, build, label, runs, tcpdump, video, datazilla,
-                     prescript, postscript, None, None, None)
+                     prescript, postscript, None, None, None, immediate)
         self.job.locations = locations
         self.job.speeds = speeds
         self.job.urls = urls
@@ -329,72 +502,34 @@ class JobMonitor(Daemon):
                              "firefox/try-builds/%s-%s/try-win32/" % (email,
                                                                       build)
 
-        try:
-            self.cursor.execute(
-                "insert into jobs(email, build, label, runs, tcpdump, video, "
-                "datazilla, prescript, postscript, status, started) "
-                "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (email, build, label, runs, tcpdump, video,
-                 datazilla, prescript, postscript, "waiting",
-                 datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")))
-            self.connection.commit()
-            self.job.id = jobid = self.cursor.lastrowid
-        except:
-            self.notify_admin_exception("Error inserting job")
-            self.notify_user_exception(email, "Error inserting job")
-            raise
-
-        for location in locations:
-            try:
-                self.cursor.execute(
-                    "insert into locations(location, jobid) "
-                    "values (?, ?)",
-                    (location, jobid))
-                self.connection.commit()
-            except:
-                self.notify_admin_exception("Error inserting location")
-                self.notify_user_exception(email, "Error inserting location")
-                self.purge_job(jobid)
-                raise
-
-        for speed in speeds:
-            try:
-                self.cursor.execute(
-                    "insert into speeds(speed, jobid) values (?, ?)",
-                    (speed, jobid))
-                self.connection.commit()
-            except:
-                msg = ("SQLError inserting speed: email: %s, build: %s, "
-                       "label: %s, location: %s" % (email, build, label, speed))
-                self.notify_admin_exception("Error inserting speed")
-                self.notify_user_exception(email, "Error inserting speed")
-                self.purge_job(jobid)
-                raise
-
+        # Read the scripts before inserting anything so that a job is
+        # only ever inserted complete.
+        script_texts = []
         for iurl in range(len(urls)):
             url = urls[iurl]
             script = scripts[iurl] if scripts and iurl < len(scripts) else ''
             if script:
-                self.job.scripts[iurl] = script
                 try:
                     script = open(os.path.join(self.scriptdir, script)).read()
                 except:
                     self.notify_admin_exception("Error reading script for url %s" % url)
                     self.notify_user_exception(email, "Error reading script for url %s" % url)
-                    self.purge_job(jobid)
                     raise
-            try:
-                self.cursor.execute(
-                    "insert into urls(url, script, jobid) values (?, ?, ?)",
-                    (url, script, jobid))
-                self.connection.commit()
-            except:
-                self.notify_admin_exception("Error inserting url")
-                self.notify_user_exception(email, "Error inserting url")
-                self.purge_job(jobid)
-                raise
+            script_texts.append(script)
+
+        try:
+            self.job.id = jobdb.insert_job(self.connection, email, build, label,
+                                           runs, tcpdump, video, datazilla,
+                                           prescript, postscript, locations,
+                                           speeds, urls, script_texts,
+                                           immediate)
+        except:
+            self.notify_admin_exception("Error inserting job")
+            self.notify_user_exception(email, "Error inserting job")
+            raise
 
         self.notify_user_info(email, "job submitted")
+        return self.job.id
 
     def job_email_boilerplate(self, subject, message=None):
         if not message:
@@ -448,33 +583,98 @@ Status:     %(status)s
 
     def notify_user_info(self, user, subject, message=None):
         job_message = self.job_email_boilerplate(subject, message)
-        self.notify_user_logger(user, subject).info(job_message)
+        with self.notify_lock:
+            self.notify_user_logger(user, subject).info(job_message)
+
+    def notify_user_digest(self, user, subject, message=None):
+        """Notify the user immediately if the current job was submitted
+        with immediate notifications. Otherwise add the notification to
+        the job's digest which is sent by send_user_digest."""
+        if not self.job or self.job.immediate:
+            self.notify_user_info(user, subject, message)
+            return
+        with self.notify_lock:
+            self.digests.setdefault(self.job.id, []).append(
+                (int(time.time()), subject, message))
+
+    def send_user_digest(self, user, subject):
+        """Notify the user with the current job's digest, if any."""
+        with self.notify_lock:
+            digest = self.digests.pop(self.job.id, []) if self.job else []
+        message = "".join(["%s %s\n\n%s\n" % (jobdb.format_time(seconds),
+                                               digest_subject,
+                                               digest_message or "")
+                           for (seconds, digest_subject, digest_message)
+                           in digest])
+        self.notify_user_info(user, subject, message)
 
     def notify_user_exception(self, user, subject, message=None):
         job_message = self.job_email_boilerplate(subject, message)
         contact_message = ("Please contact your administrators %s for help." %
                            self.admin_toaddrs)
         job_message = "%s%s" % (job_message, contact_message)
-        self.notify_user_logger(user, subject).exception(job_message)
+        with self.notify_lock:
+            self.notify_user_logger(user, subject).exception(job_message)
 
     def notify_user_error(self, user, subject, message=None):
         job_message = self.job_email_boilerplate(subject, message)
         contact_message = ("Please contact your administrators %s for help." %
                            self.admin_toaddrs)
         job_message = "%s%s" % (job_message, contact_message)
-        self.notify_user_logger(user, subject).error(job_message)
+        with self.notify_lock:
+            self.notify_user_logger(user, subject).error(job_message)
 
     def notify_admin_info(self, subject, message=None):
         job_message = self.job_email_boilerplate(subject, message)
-        self.notify_admin_logger(subject).info(job_message)
+        with self.notify_lock:
+            self.notify_admin_logger(subject).info(job_message)
 
     def notify_admin_exception(self, subject, message=None):
+        if not self.admin_alert_is_new(subject, sys.exc_info()):
+            return
         job_message = self.job_email_boilerplate(subject, message)
-        self.notify_admin_logger(subject).exception(job_message)
+        with self.notify_lock:
+            self.notify_admin_logger(subject).exception(job_message)
 
     def notify_admin_error(self, subject, message=None):
+        if not self.admin_alert_is_new(subject, None):
+            return
         job_message = self.job_email_boilerplate(subject, message)
-        self.notify_admin_logger(subject).error(job_message)
+        with self.notify_lock:
+            self.notify_admin_logger(subject).error(job_message)
+
+    def admin_alert_is_new(self, subject, exc_info):
+        """Return True if the admin alert reported by the caller of
+        notify_admin_exception or notify_admin_error is the first with
+        its fingerprint within alert_window seconds. Otherwise log it
+        without its traceback to be counted in a later summary.
+        """
+        self.notify_admin_summaries()
+        alert_fingerprint = fingerprint(exc_info, sys._getframe(2))
+        if self.admin_alerts.record(alert_fingerprint, subject):
+            return True
+        self.logger.warning("repeated admin alert: %s: %s%s" %
+                            (alert_fingerprint, subject,
+                             ": %s" % exc_info[1] if exc_info else ""))
+        return False
+
+    def notify_admin_summaries(self, force=False):
+        """Email the admins a summary of the alerts which repeated
+        during their windows."""
+        summaries = self.admin_alerts.summaries(force)
+        if not summaries:
+            return
+        subject = "[WebPagetest] %d repeated alerts" % sum(
+            [count for (alert_fingerprint, alert_subject, count, last)
+             in summaries])
+        message = "Alerts repeated since they were last sent:\n\n"
+        for (alert_fingerprint, alert_subject, count, last) in summaries:
+            message += "%d x %s\n    %s\n    last: %s\n\n" % (
+                count, alert_subject, alert_fingerprint,
+                jobdb.format_time(last))
+        with self.notify_lock:
+            self.emailhandler.subject = subject
+            self.emaillogger.error(message)
 
     def purge_job(self, jobid):
         """Purge the job whose id is jobid along with all of the
@@ -482,59 +682,91 @@ Status:     %(status)s
         """
         if not jobid:
             return
+        self.purge_jobs([jobid])
 
-        jobparm = {"jobid": jobid}
+    def purge_jobs(self, jobids):
+        """Purge the jobs whose ids are in jobids along with all of
+        their linked locations, speeds, and urls in one transaction.
+        """
+        # Send what the current job's digest has collected before the
+        # job ended.
+        if (self.job and self.job.id in jobids and
+            self.job.id in self.digests):
+            self.send_user_digest(self.job.email, "job ended early.")
         try:
-            self.cursor.execute("delete from urls where jobid=:jobid",
-                                jobparm)
-            self.cursor.execute("delete from speeds where jobid=:jobid",
-                                jobparm)
-            self.cursor.execute("delete from locations where jobid=:jobid",
-                                jobparm)
-            self.cursor.execute("delete from jobs where id=:jobid",
-                                jobparm)
-            self.connection.commit()
+            jobdb.delete_jobs(self.connection, jobids)
         except:
-            self.notify_admin_exception("Exception purging job %s" % jobid)
+            self.notify_admin_exception("Exception purging jobs %s" %
+                                        ", ".join([str(jobid)
+                                                   for jobid in jobids]))
         finally:
-            if self.job and self.job.id == jobid:
+            if self.job and self.job.id in jobids:
                 self.job = None
 
+    def get_build_links(self, build):
+        """Return the list of the hrefs in the directory listing at the
+        url build. The listing's ETag and Last-Modified headers are
+        remembered so that an unchanged listing only costs a 304 Not
+        Modified response.
+        """
+        headers = {}
+        cached = self.listing_cache.get(build)
+        if cached:
+            (etag, last_modified, hrefs) = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        builddir_resp, builddir_content = self.http.request(build, "GET",
+                                                            headers=headers)
+        if builddir_resp.status == 304 and cached:
+            return cached[2]
+        if builddir_resp.status != 200:
+            self.listing_cache.pop(build, None)
+            return []
+        hrefs = re_href.findall(builddir_content)
+        self.listing_cache[build] = (builddir_resp.get("etag"),
+                                     builddir_resp.get("last-modified"),
+                                     hrefs)
+        return hrefs
+
     def check_build(self, build):
         """Check the build url to see if build is available. build can
         be either a direct link to a build or a link to a directory
         containing the build. If the build is available, then
-        check_build will return the actual url to the build.
+        check_build will return the actual url to the build. If the
+        directory contains more than one build, the url of the build
+        with the highest version is returned.
         """
-        # TODO(bc) if build is a directory, then we need to pick the
-        # latest url.
-
         buildurl = None
-        re_builds = re.compile(r"firefox-([0-9]+).*\.win32\.installer\.exe")
-
-        httplib = httplib2.Http(proxy_info = get_proxy_info);
 
         if not build.endswith("/"):
             # direct url to a build implies the build is available now.
             buildurl = build
         else:
             try:
-                builddir_resp, builddir_content = httplib.request(build, "GET")
-                if builddir_resp.status == 200:
-                    builddir_soup = BeautifulSoup.BeautifulSoup(builddir_content)
-                    for build_link in builddir_soup.findAll("a"):
-                        match = re_builds.match(build_link.get("href"))
-                        if match:
-                            buildurl = "%s%s" % (build, build_link.get("href"))
+                buildversion = None
+                for href in self.get_build_links(build):
+                    build_name = href.split("/")[-1]
+                    match = re_builds.match(build_name)
+                    if match:
+                        version = build_version_key(match)
+                        if buildversion is None or version > buildversion:
+                            buildversion = version
+                            buildurl = "%s%s" % (build, build_name)
             except:
-                # Which exceptions here? from httplib, BeautifulSoup
+                # Which exceptions here? from httplib
                 self.notify_admin_exception("Error checking build")
                 buildurl = None
 
         if buildurl:
-            buildurl_resp, buildurl_content = httplib.request(buildurl, "HEAD")
+            buildurl_resp, buildurl_content = self.http.request(buildurl, "HEAD")
             if buildurl_resp.status != 200:
                 buildurl = None
+            else:
+                self.build_validators[buildurl] = (
+                    buildurl_resp.get("etag"),
+                    buildurl_resp.get("last-modified"))
 
         return buildurl
 
@@ -543,7 +775,8 @@ Status:     %(status)s
         """
         try:
             self.cursor.execute(
-                "select * from jobs where status = 'pending' order by started")
+                "select * from jobs where status = :status order by started",
+                {"status": jobdb.PENDING})
             jobrow = self.cursor.fetchone()
         except sqlite3.OperationalError:
             self.notify_admin_exception("Error finding pending jobs")
@@ -554,27 +787,29 @@ Status:     %(status)s
 
         (jobid, email, build, label, runs, tcpdump, video, datazilla,
          prescript, postscript,
-         status, started, timestamp) = jobrow
+         status, started, timestamp, immediate) = jobrow
         self.set_job(jobid, email, build, label, runs, tcpdump, video, datazilla,
-                     prescript, postscript, status, started, timestamp)
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-        self.job.status = status = "running"
+                     prescript, postscript, status, started, timestamp,
+                     immediate)
+        timestamp = int(time.time())
+        self.job.status = jobdb.status_name(jobdb.RUNNING)
         self.logger.debug("jobid: %s, email: %s, build: %s, label: %s, "
                           "runs; %s, tcpdump: %s, video: %s, datazilla: %s, "
                           "prescript: %s, postscript: %s, status: %s, "
                           "started: %s, timestamp: %s" %
                           (jobid, email, build, label,
                            runs, tcpdump, video, datazilla, prescript,
-                           postscript, status,
-                           started, timestamp))
+                           postscript, self.job.status,
+                           jobdb.format_time(started),
+                           jobdb.format_time(timestamp)))
         try:
             self.cursor.execute(
                 "update jobs set build=:build, status=:status, "
                 "timestamp=:timestamp where id=:jobid",
-                {"jobid": jobid, "build": build, "status": status,
+                {"jobid": jobid, "build": build, "status": jobdb.RUNNING,
                  "timestamp": timestamp})
             self.connection.commit()
-            self.notify_user_info(email, "job is running")
+            self.notify_user_digest(email, "job is running")
         except sqlite3.OperationalError:
             self.notify_admin_exception("Error updating running job")
             self.notify_user_exception(email, "Error updating running job")
@@ -585,31 +820,184 @@ Status:     %(status)s
             self.purge_job(jobid)
             return
 
-        for location in self.job.locations:
-            self.process_location(location)
-
-        self.job.status = "completed"
-        self.notify_user_info(email, "job completed.")
+        location_groups = self.get_location_groups(self.job.locations)
+        if len(location_groups) == 1:
+            self.process_locations(location_groups[0])
+        else:
+            exc_infos = []
+            threads = [threading.Thread(
+                target=self.group_context().process_locations,
+                args=(locations, exc_infos))
+                       for locations in location_groups]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if exc_infos:
+                exc_info = exc_infos[0]
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+        self.job.status = jobdb.status_name(jobdb.COMPLETED)
+        self.send_user_digest(email, "job completed.")
         self.purge_job(jobid)
+        self.log_http_stats()
+
+    def get_location_groups(self, locations):
+        """Return the list of lists of locations in each isolation
+        group in the order of their first location.
+        """
+        group_names = []
+        group_map = {}
+        for location in locations:
+            machine_name = location.split(":")[0]
+            group_name = self.isolation_groups.get(
+                location, self.isolation_groups.get(machine_name))
+            if group_name not in group_map:
+                group_names.append(group_name)
+                group_map[group_name] = []
+            group_map[group_name].append(location)
+        return [group_map[group_name] for group_name in group_names]
+
+    def group_context(self):
+        """Return a copy of the monitor for a thread which processes an
+        isolation group of the current job.
+
+        The copy has its own copies of the job and of the build
+        information, so nothing one group thread sets is seen by the
+        others or by the main thread. It shares the monitor's locks,
+        http pool, loggers and digests, which are safe to use from
+        several threads, and opens its own database connection.
+        """
+        context = copy.copy(self)
+        context.job = copy.copy(self.job)
+        for name in ("locations", "speeds", "urls", "scripts"):
+            value = getattr(self.job, name)
+            if value is not None:
+                setattr(context.job, name, list(value))
+        context.thread_local = threading.local()
+        return context
+
+    def process_locations(self, locations, exc_infos=None):
+        """Process each of the locations one at a time. If exc_infos is
+        a list, an exception is appended to it rather than raised so
+        that it can be raised by the thread which started this one, and
+        the thread's database connection is closed when it is done.
+        """
+        try:
+            for location in locations:
+                self.process_location(location)
+        except:
+            if exc_infos is None:
+                raise
+            exc_infos.append(sys.exc_info())
+        finally:
+            if exc_infos is not None:
+                self.close_thread_connection()
+
+    def log_http_stats(self):
+        """Log the request counts and latencies of the http pool
+        for each host.
+        """
+        host_stats = self.http.stats()
+        for host in sorted(host_stats.keys()):
+            stats = host_stats[host]
+            self.logger.info("http %s: requests: %d, errors: %d, "
+                             "latency mean: %.3f max: %.3f seconds" % (
+                                 host, stats["requests"], stats["errors"],
+                                 stats["mean_seconds"], stats["max_seconds"]))
+
+    def prefetch_build(self, buildurl):
+        """Start downloading buildurl to the staging directory in the
+        background unless it is already being prefetched and return
+        its BuildPrefetch.
+        """
+        prefetch = self.prefetches.get(buildurl)
+        if not prefetch or prefetch.exc_info:
+            self.logger.debug("prefetching build: %s" % buildurl)
+            (etag, last_modified) = self.build_validators.get(buildurl,
+                                                              (None, None))
+            prefetch = BuildPrefetch(self.http, buildurl, self.stagingdir,
+                                     cache=self.build_cache, etag=etag,
+                                     last_modified=last_modified)
+            self.prefetches[buildurl] = prefetch
+            prefetch.start()
+        return prefetch
+
+    def discard_prefetches(self):
+        """Discard the finished prefetches of builds which are no
+        longer needed by a pending job.
+        """
+        try:
+            self.cursor.execute(
+                "select distinct build from jobs where status = :status",
+                {"status": jobdb.PENDING})
+            pending_builds = set([jobrow[0] for jobrow in self.cursor.fetchall()])
+        except sqlite3.OperationalError:
+            self.notify_admin_exception("Error checking pending builds")
+            raise
+        for buildurl in self.prefetches.keys():
+            prefetch = self.prefetches[buildurl]
+            if buildurl not in pending_builds and not prefetch.is_alive():
+                self.logger.debug("discarding prefetched build: %s" % buildurl)
+                prefetch.discard()
+                del self.prefetches[buildurl]
+                self.build_validators.pop(buildurl, None)
+
+    def discard_listings(self):
+        """Discard the cached build directory listings which are no
+        longer needed by a waiting job.
+        """
+        try:
+            self.cursor.execute(
+                "select distinct build from jobs where status = :status",
+                {"status": jobdb.WAITING})
+            waiting_builds = set([jobrow[0] for jobrow in self.cursor.fetchall()])
+        except sqlite3.OperationalError:
+            self.notify_admin_exception("Error checking waiting builds")
+            raise
+        for build in self.listing_cache.keys():
+            if build not in waiting_builds:
+                del self.listing_cache[build]
 
     def download_build(self):
-        """Download a build to the webpagetest server and
+        """Install the prefetched build on the webpagetest server and
         update the firefox.dat file.
         """
         self.logger.debug("downloading build: %s" % self.job.build)
 
+        # Normally the build was prefetched when check_waiting_jobs
+        # found it. Otherwise this starts the download now.
+        prefetch = self.prefetch_build(self.job.build)
+        # A partial download is kept so that the next prefetch of the
+        # build resumes it. HttpPool.download discards it if it fails
+        # verification or the build has changed.
         try:
-            if os.path.exists(self.firefoxpath):
-                os.unlink(self.firefoxpath)
-
-            urllib.urlretrieve(self.job.build, self.firefoxpath)
-            #fh = open(firefoxpath)
-            #md5sum = md5.new()
-            #md5sum.update(fh.read())
-            #md5digest = md5sum.hexdigest()
-            #fh.close()
+            prefetch.wait()
         except IOError:
-            self.notify_admin_exception("Error downloading build")
+            del self.prefetches[self.job.build]
+            prefetch.discard(partial=False)
+            if not prefetch.downloaded:
+                self.notify_admin_exception("Error downloading build")
+                self.notify_user_exception(self.job.email,
+                                           "Error downloading build")
+            else:
+                self.notify_admin_exception("Error reading application.ini")
+                self.notify_user_exception(self.job.email,
+                                           "job failed")
+            return False
+        except:
+            del self.prefetches[self.job.build]
+            prefetch.discard(partial=False)
+            raise
+
+        # The staged build is in the same directory as firefoxpath so
+        # the rename atomically replaces the previous build.
+        del self.prefetches[self.job.build]
+        try:
+            os.rename(prefetch.path, self.firefoxpath)
+        except OSError:
+            prefetch.discard()
+            self.notify_admin_exception("Error installing build")
             self.notify_user_exception(self.job.email, "Error downloading build")
             return False
         try:
@@ -617,37 +1005,25 @@ Status:     %(status)s
             builddat.write("browser=Firefox\n")
             builddat.write("url=http://%s/installers/browsers/"
                            "firefox-installer.exe\n" % self.server)
-            #builddat.write("md5=%s\n" % md5digest)
+            builddat.write("md5=%s\n" % prefetch.md5)
             # need to create a random version here so wpt will install it.
             builddat.write("version=%d\n" % int(100*random.random()))
             builddat.write("command=firefox-installer.exe "
                            "/INI=c:\\webpagetest\\firefox.ini\n")
             builddat.write("update=1\n")
             builddat.close()
+            updated = time.time()
         except IOError:
             self.notify_admin_exception("Error writing firefox.dat")
             self.notify_user_exception(self.job.email,
                                        "job failed")
             return False
 
-        # Get information about the build by extracting the installer
-        # to a temporary directory and parsing the application.ini file.
-        tempdirectory = tempfile.mkdtemp()
-        returncode = subprocess.call(["7z", "x", self.firefoxpath,
-                                      "-o%s" % tempdirectory])
-        appini = ConfigParser.RawConfigParser()
-        try:
-            appini.readfp(open("%s/core/application.ini" % tempdirectory))
-        except IOError:
-            self.notify_admin_exception("Error reading application.ini")
-            self.notify_user_exception(self.job.email,
-                                       "job failed")
-            return False
-        self.build_name = appini.get("App", "name")
-        self.build_version = appini.get("App", "version")
-        self.build_id = appini.get("App", "buildID")
-        self.build_branch = os.path.basename(appini.get("App", "SourceRepository"))
-        self.build_revision = appini.get("App", "SourceStamp")
+        self.build_name = prefetch.build_info["name"]
+        self.build_version = prefetch.build_info["version"]
+        self.build_id = prefetch.build_info["id"]
+        self.build_branch = prefetch.build_info["branch"]
+        self.build_revision = prefetch.build_info["revision"]
 
         self.logger.debug("build_name: %s" % self.build_name)
         self.logger.debug("build_version: %s" % self.build_version)
@@ -655,26 +1031,112 @@ Status:     %(status)s
         self.logger.debug("build_branch: %s" % self.build_branch)
         self.logger.debug("build_revision: %s" % self.build_revision)
 
-        if returncode != 0:
-            raise Exception("download_build: "
-                            "error extracting build: rc=%d" % returncode)
-        shutil.rmtree(tempdirectory)
-
-        # delay after updating firefox.dat to give the clients time to
-        # check for the updated build.
-        time.sleep(120)
+        # wait for the clients to check for the updated build.
+        pending_agents = self.wait_for_agents(updated)
+        if pending_agents:
+            self.notify_admin_error(
+                "Testers not ready",
+                "Testing %s for job %s although these testers had not "
+                "checked in %d seconds after the build was installed: %s" %
+                (self.build_name, self.job.id, self.agent_ready_timeout,
+                 ", ".join(pending_agents)))
         return True
 
+    def wait_for_agents(self, updated):
+        """Wait until every tester in the job's locations has checked
+        in with webpagetest since firefox.dat was updated at the time
+        updated and so has been offered the new build. Returns the list
+        of the testers which are still pending after agent_ready_timeout
+        seconds, which is empty if they are all ready. If getTesters.php
+        is unavailable, waits agent_fallback_delay seconds after updated
+        instead.
+        """
+        location_ids = set([location.split(":")[0]
+                            for location in self.job.locations])
+        deadline = updated + self.agent_ready_timeout
+        observed = {}
+        checked_in = set()
+        while True:
+            pending_agents = self.get_pending_agents(location_ids, updated,
+                                                     observed, checked_in)
+            if pending_agents is None:
+                delay = updated + self.agent_fallback_delay - time.time()
+                self.logger.warning("getTesters.php unavailable, waiting "
+                                    "%.0f seconds for agents" % max(0, delay))
+                time.sleep(max(0, min(delay, deadline - time.time())))
+                return []
+            if not pending_agents:
+                self.logger.debug("agents ready after %.1f seconds" %
+                                  (time.time() - updated))
+                return []
+            if time.time() >= deadline:
+                self.logger.warning("agents not ready after %d seconds: %s" %
+                                    (self.agent_ready_timeout, pending_agents))
+                return pending_agents
+            self.logger.debug("waiting for agents: %s" % pending_agents)
+            time.sleep(max(0, min(self.poll_min_time, deadline - time.time())))
+
+    def get_pending_agents(self, location_ids, updated, observed, checked_in):
+        """Return the list of the location ids and testers from
+        webpagetest's getTesters.php which have not checked in since
+        the time updated, or None if getTesters.php is unavailable. A
+        location without testers or which getTesters.php does not
+        report is pending. observed maps each tester to the elapsed
+        minutes it reported at the previous call for the same update
+        and checked_in is the set of the testers already known to have
+        checked in since then.
+        """
+        request_url = 'http://%s/getTesters.php?f=json' % self.server
+        try:
+            response, content = self.http.request(request_url)
+            if response.status != 200:
+                return None
+            locations_data = json.loads(content)["data"]
+        except (IOError, ValueError, KeyError, httplib2.HttpLib2Error):
+            return None
+        # elapsed is the number of whole minutes since the tester last
+        # checked in, so a check-in is known to be after updated once a
+        # full minute more than elapsed has passed, or as soon as
+        # elapsed drops below the value seen at an earlier call, which
+        # was itself made after updated.
+        since_updated = time.time() - updated
+        pending_agents = []
+        for location_id in sorted(location_ids):
+            location_data = locations_data.get(location_id)
+            testers = location_data.get("testers") if location_data else None
+            if isinstance(testers, dict):
+                testers = testers.get("tester")
+            if isinstance(testers, dict):
+                testers = [testers]
+            if not testers:
+                pending_agents.append(location_id)
+                continue
+            for tester in testers:
+                agent = "%s %s" % (location_id,
+                                   tester.get("id", tester.get("pc")))
+                try:
+                    elapsed = int(tester.get("elapsed"))
+                except (TypeError, ValueError):
+                    pending_agents.append(agent)
+                    continue
+                if (agent in observed and elapsed < observed[agent] or
+                    (elapsed + 1) * 60 <= since_updated):
+                    checked_in.add(agent)
+                observed[agent] = elapsed
+                if agent not in checked_in:
+                    pending_agents.append(agent)
+        return pending_agents
+
     def process_location(self, location):
         """Submit jobs for this location for each speed and url.
         """
         self.logger.debug("process_location: %s" % location)
 
         # We can submit any number of speeds and urls for a given
-        # location, but we can't submit more than one location at
-        # a time since it might affect the network performance if
-        # multiple machines are downloading builds, running tests
-        # simultaneously.
+        # location, but we can't submit more than one location of an
+        # isolation group at a time since it might affect the network
+        # performance if multiple machines are downloading builds,
+        # running tests simultaneously.
 
         def add_msg(test_msg_map, test_id, msg):
             if test_id not in test_msg_map:
@@ -686,7 +1148,11 @@ Status:     %(status)s
         messages = ""
         test_url_map = {}
         test_speed_map = {}
-        for speed in self.job.speeds:
+        # Collect the runtest.php request for every speed and url
+        # first so that they can be submitted concurrently.
+        submissions = []
+        for ispeed in range(len(self.job.speeds)):
+            speed = self.job.speeds[ispeed]
             self.logger.debug("process_location: location: %s, speed: %s" %
                               (location, speed))
 
@@ -720,7 +1186,6 @@ Status:     %(status)s
                     self.job.prescript, self.job.postscript,
                     self.job.scripts,
                     wpt_parameters, self.server))
-            partial_test_url_map = {}
             for iurl in range(len(self.job.urls)):
                 url = self.job.urls[iurl]
                 script = self.job.scripts[iurl] if self.job.scripts else ''
@@ -744,11 +1209,23 @@ Status:     %(status)s
 
                 request_url = 'http://%s/runtest.php?%s' % (self.server,
                                                             urllib.urlencode(wpt_parameters))
-                response = urllib.urlopen(request_url)
-                if response.getcode() == 200:
-                    response_data = json.loads(response.read())
-                    if response_data['statusCode'] == 200:
-                        partial_test_url_map[response_data['data']['testId']] = url
+                submissions.append((ispeed, url, request_url))
+
+        submit_start = time.time()
+        submitted_test_ids = self.map_concurrently(
+            self.submit_test,
+            [request_url for (ispeed, url, request_url) in submissions])
+        self.logger.debug("submitted %d tests in %.1f seconds" %
+                          (len(submissions), time.time() - submit_start))
+
+        for ispeed in range(len(self.job.speeds)):
+            speed = self.job.speeds[ispeed]
+            partial_test_url_map = {}
+            for isubmission in range(len(submissions)):
+                (submission_ispeed, url, request_url) = submissions[isubmission]
+                test_id = submitted_test_ids[isubmission]
+                if submission_ispeed == ispeed and test_id:
+                    partial_test_url_map[test_id] = url
             self.logger.debug("partial_test_url_map: %s" % partial_test_url_map)
             accepted_urls = partial_test_url_map.values()
             for url in self.job.urls:
@@ -770,6 +1247,16 @@ Status:     %(status)s
         terminate_time = (datetime.datetime.now() +
                           datetime.timedelta(seconds=total_time_limit))
 
+        # Each pending test is polled on its own schedule. next_poll_map
+        # holds the time of the next poll for a test and last_poll_map
+        # the time of its previous poll which bounds the latency added
+        # by polling once the test is seen to be complete.
+        now = time.time()
+        next_poll_map = dict.fromkeys(pending_test_url_map, now)
+        last_poll_map = dict.fromkeys(pending_test_url_map, now)
+        poll_requests = 0
+        poll_latencies = []
+
         while pending_test_url_map:
             self.logger.debug("pending_test_url_map: %s" % pending_test_url_map)
             if datetime.datetime.now() > terminate_time:
@@ -779,47 +1266,73 @@ Status:     %(status)s
                     add_msg(test_msg_map, test_id,
                             "abandoned due to time limit.")
                 continue
+            now = time.time()
+            due_test_ids = [test_id for test_id in pending_test_url_map
+                            if next_poll_map[test_id] <= now]
             self.logger.debug(
                 "CheckBatchStatus: email: %s, build: %s, label: %s, "
-                "location: %s, speed: %s, urls: %s" % (
+                "location: %s, tests: %s" % (
                     self.job.email, self.job.build, self.job.label,
-                    location, speed, self.job.urls))
-            test_status_map = {}
-            for test_id in pending_test_url_map.keys():
-                request_url = 'http://%s/testStatus.php?f=json&test=%s' % (self.server,
-                                                                           test_id)
-                response = urllib.urlopen(request_url)
-                if response.getcode() == 200:
-                    response_data = json.loads(response.read())
-                    test_status = response_data['statusCode']
-                    test_status_map[test_id] = test_status
-                    if test_status == 100:
-                        test_status_text = "started"
-                    elif test_status == 101:
-                        test_status_text = "waiting"
-                    elif test_status == 200:
-                        test_status_text = "complete"
-                        del pending_test_url_map[test_id]
-                    elif test_status == 400 or test_status == 401:
-                        test_status_text = "not found"
-                        del pending_test_url_map[test_id]
-                        add_msg(test_msg_map, test_id, "not found")
-                    elif test_status == 402:
-                        test_status_text = "cancelled"
-                        del pending_test_url_map[test_id]
-                        add_msg(test_msg_map, test_id, "cancelled")
-                    else:
-                        test_status_text = "unexpected failure"
-                        del pending_test_url_map[test_id]
-                        add_msg(test_msg_map, test_id,
-                                "failed with unexpected status %s" % test_status)
-                    self.logger.debug("processing test status %s %s %s" %
-                                      (test_id, test_status, test_status_text))
+                    location, due_test_ids))
+            test_status_list = self.map_concurrently(self.get_test_status,
+                                                     due_test_ids)
+            poll_requests += len(due_test_ids)
+            polled = time.time()
+            for itest in range(len(due_test_ids)):
+                test_id = due_test_ids[itest]
+                response_data = test_status_list[itest]
+                if not response_data:
+                    # The test is still pending after a failed poll,
+                    # which is retried after the longest interval.
+                    next_poll_map[test_id] = polled + self.sleep_time
+                    continue
+                test_status = response_data['statusCode']
+                if test_status == 100:
+                    test_status_text = "started"
+                elif test_status == 101:
+                    test_status_text = "waiting"
+                elif test_status == 200:
+                    test_status_text = "complete"
+                    del pending_test_url_map[test_id]
+                elif test_status == 400 or test_status == 401:
+                    test_status_text = "not found"
+                    del pending_test_url_map[test_id]
+                    add_msg(test_msg_map, test_id, "not found")
+                elif test_status == 402:
+                    test_status_text = "cancelled"
+                    del pending_test_url_map[test_id]
+                    add_msg(test_msg_map, test_id, "cancelled")
+                else:
+                    test_status_text = "unexpected failure"
+                    del pending_test_url_map[test_id]
+                    add_msg(test_msg_map, test_id,
+                            "failed with unexpected status %s" % test_status)
+                self.logger.debug("processing test status %s %s %s" %
+                                  (test_id, test_status, test_status_text))
+                if test_status == 200:
+                    poll_latencies.append(polled - last_poll_map[test_id])
+                elif test_id in pending_test_url_map:
+                    next_poll_map[test_id] = polled + self.get_poll_interval(
+                        test_status, response_data.get('data'))
+                last_poll_map[test_id] = polled
 
             if pending_test_url_map:
+                sleep_time = max(0, min([next_poll_map[test_id]
+                                         for test_id in pending_test_url_map]) -
+                                 time.time())
                 self.logger.debug("Finished checking batch status, "
-                                  "sleeping %d seconds..." % self.sleep_time)
-                time.sleep(self.sleep_time)
+                                  "sleeping %d seconds..." % sleep_time)
+                time.sleep(sleep_time)
+
+        # The latency added by polling for a completed test is at most
+        # the time between the last two polls of the test.
+        if poll_latencies:
+            self.poll_latency[location] = max(poll_latencies)
+            self.logger.info("polling for location %s: %d requests, "
+                             "added latency mean %.1f max %.1f seconds" % (
+                                 location, poll_requests,
+                                 sum(poll_latencies) / len(poll_latencies),
+                                 max(poll_latencies)))
 
         if messages:
             messages = "\n" + messages
@@ -827,6 +1340,112 @@ Status:     %(status)s
         self.process_test_results(location, test_speed_map, test_url_map,
                                   test_msg_map, messages)
 
+    def map_concurrently(self, func, items):
+        """Call func for each item using a pool of at most
+        submit_workers threads and return the list of results in the
+        same order as items. A database connection opened by func is
+        closed before its worker thread goes on to the next item.
+        """
+        if not items:
+            return []
+
+        def call(item):
+            try:
+                return func(item)
+            finally:
+                self.close_thread_connection()
+
+        pool = ThreadPool(min(self.submit_workers, len(items)))
+        try:
+            return pool.map(call, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_test_status(self, test_id):
+        """Return the response from webpagetest's testStatus.php for
+        the test or None if the request failed, which is logged.
+        """
+        request_url = 'http://%s/testStatus.php?f=json&test=%s' % (self.server,
+                                                                   test_id)
+        try:
+            response, content = self.http.request(request_url)
+            if response.status != 200:
+                self.logger.warning("error polling test %s: status %s" %
+                                    (test_id, response.status))
+                return None
+            response_data = json.loads(content)
+            if 'statusCode' not in response_data:
+                raise ValueError("no statusCode")
+            return response_data
+        except (IOError, ValueError, TypeError, httplib2.HttpLib2Error), e:
+            self.logger.warning("error polling test %s: %s" % (test_id, e))
+            return None
+
+    def get_poll_interval(self, test_status, test_status_data):
+        """Return the number of seconds to wait before polling a test
+        again. Tests waiting behind other tests in the queue are
+        polled less often the further back they are while started
+        tests are polled more often as they approach completion.
+        """
+        if not isinstance(test_status_data, dict):
+            return self.sleep_time
+        try:
+            if test_status == 101:
+                # waiting behind behindCount other tests.
+                remaining = int(test_status_data.get('behindCount', 0)) + 1
+            elif test_status == 100:
+                # started, running the remaining tests.
+                tests_expected = int(test_status_data.get('testsExpected', 0))
+                tests_completed = int(test_status_data.get('testsCompleted',
+                                                           0))
+                remaining = max(1, tests_expected - tests_completed)
+            else:
+                return self.sleep_time
+        except (TypeError, ValueError):
+            return self.sleep_time
+        return max(self.poll_min_time,
+                   min(self.sleep_time, self.poll_min_time * remaining))
+
+    def submit_test(self, request_url):
+        """Submit a test to webpagetest's runtest.php and return the
+        test id if the test was accepted or None otherwise. A failed
+        request is logged and treated as not accepted so that it does
+        not lose the tests submitted with it.
+        """
+        try:
+            response, content = self.http.request(request_url)
+            if response.status == 200:
+                response_data = json.loads(content)
+                if response_data['statusCode'] == 200:
+                    return response_data['data']['testId']
+        except (IOError, ValueError, KeyError, TypeError,
+                httplib2.HttpLib2Error), e:
+            self.logger.warning("error submitting test %s: %s" %
+                                (request_url, e))
+        return None
+
+    def read_test_result(self, test_id, result_url):
+        """Return the compact record of the jsonResult at result_url,
+        parsed as it is streamed from webpagetest. When the admin log
+        level is DEBUG, the jsonResult is also appended to
+        results-<test_id>.json in the log directory.
+        """
+        result_file = self.http.open(result_url)
+        try:
+            if self.admin_loglevel != logging.DEBUG:
+                return extract_result(result_file)
+            logdir = os.path.dirname(self.logfile)
+            result_json = open(os.path.join(logdir, "results-%s.json" % test_id), "a+")
+            try:
+                test_result = extract_result(TeeReader(result_file, result_json))
+                result_json.write("\n")
+            finally:
+                result_json.close()
+            return test_result
+        finally:
+            result_file.close()
+
     def process_test_results(self, location, test_speed_map, test_url_map,
                              test_msg_map, messages):
         """Process test results, notifying user of the results.
@@ -840,6 +1459,7 @@ Status:     %(status)s
         msg_subject = "Results for location %s." % location
         msg_body = "Results for location %s\n\n" %  location
         msg_body_map = {}
+        nregressions = 0
         runs = int(self.job.runs)
         for test_id in test_url_map.keys():
             url = test_url_map[test_id]
@@ -878,44 +1498,61 @@ Status:     %(status)s
                                                        test_id)
             self.logger.debug("Getting result for test %s result_url %s" %
                               (test_id, result_url))
-            result_response = urllib.urlopen(result_url)
-            if result_response.getcode() != 200:
+            test_result = None
+            try:
+                test_result = self.read_test_result(test_id, result_url)
+            except (IOError, ValueError):
                 msg = "Failed to retrieve results from Webpagetest"
                 msg_body_map[msg_body_key] += msg
-                self.notify_admin_error(msg)
-            else:
-                test_result = json.loads(result_response.read())
+                self.notify_admin_exception(msg)
+            if test_result:
+                wpt_data = None
                 if test_result["statusCode"] == 200:
                     try:
-                        datazilla_dataset = self.post_to_datazilla(test_result)[0]
-                        if not build_version:
-                            test_build_data = datazilla_dataset["test_build"]
-                            build_name = test_build_data["name"]
-                            build_version = test_build_data["version"]
-                            build_revision = test_build_data["revision"]
-                            build_id = test_build_data["id"]
-                            build_branch = test_build_data["branch"]
-                        wpt_data = datazilla_dataset["wpt_data"]
-                        for view in "firstView", "repeatView":
-                            view_data = wpt_data[view]
-                            msg_body_map[msg_body_key] += "  %s:\n" % view
-                            view_data_keys = view_data.keys()
-                            view_data_keys.sort()
-                            for data_key in view_data_keys:
-                                msg_body_map[msg_body_key] += "    %s: %s\n" % (data_key, view_data[data_key])
-                        msg_body_map[msg_body_key] += "\n"
+                        (wpt_data, wpt_runs) = self.get_wpt_data(test_result)
                     except:
-                        msg = "Error processing test result into datazilla"
+                        msg = "Error processing test result"
                         msg_body_map[msg_body_key] += msg
                         self.notify_admin_exception(msg)
+                if wpt_data:
+                    # The results are stored whether or not they can be
+                    # submitted to datazilla.
+                    if self.store_results(test_id, wpt_data, wpt_runs):
+                        comparisons = self.check_regressions(test_id,
+                                                             wpt_data)
+                    else:
+                        comparisons = []
+                    try:
+                        self.post_to_datazilla(test_result, wpt_data)
+                    except:
+                        msg = "Error submitting test result to datazilla"
+                        msg_body_map[msg_body_key] += msg + "\n"
+                        self.notify_admin_exception(msg)
+                    if not build_version:
+                        build_name = self.build_name
+                        build_version = self.build_version
+                        build_revision = self.build_revision
+                        build_id = self.build_id
+                        build_branch = self.build_branch
+                    for view in "firstView", "repeatView":
+                        view_data = wpt_data[view]
+                        msg_body_map[msg_body_key] += "  %s:\n" % view
+                        view_data_keys = view_data.keys()
+                        view_data_keys.sort()
+                        for data_key in view_data_keys:
+                            msg_body_map[msg_body_key] += "    %s: %s\n" % (data_key, view_data[data_key])
+                    msg_body_map[msg_body_key] += "\n"
+                    nregressions += len(
+                        [comparison for comparison in comparisons
+                         if comparison["result"] == "regression"])
+                    changes = wptregress.format_changes(comparisons)
+                    if changes:
+                        msg_body_map[msg_body_key] += changes + "\n"
                 if self.admin_loglevel == logging.DEBUG:
                     logdir = os.path.dirname(self.logfile)
                     result_txt = open(os.path.join(logdir, "results-%s.txt" % test_id), "a+")
                     result_txt.write(msg_body)
                     result_txt.close()
-                    result_json = open(os.path.join(logdir, "results-%s.json" % test_id), "a+")
-                    result_json.write(json.dumps(test_result, indent=4, sort_keys=True) + "\n")
-                    result_json.close()
                 test_result = None
 
         if build_name:
@@ -934,110 +1571,142 @@ Status:     %(status)s
                 msg_body += msg_body_map[msg_body_key]
         if messages:
             msg_body += "\n\n%s\n" % messages
-        self.notify_user_info(self.job.email, msg_subject, msg_body)
+        if nregressions:
+            msg_subject = "Results for location %s: %d regressions." % (
+                location, nregressions)
+        self.notify_user_digest(self.job.email, msg_subject, msg_body)
+
+    def store_results(self, test_id, wpt_data, wpt_runs):
+        """Keep the test's results in the results store and return the
+        number of values stored."""
+        try:
+            nvalues = jobdb.insert_results(self.connection, test_id,
+                                           self.job.id, self.job.label,
+                                           self.build_revision, self.build_id,
+                                           wpt_data, wpt_runs)
+            self.logger.debug("store_results: stored %d values for test %s" %
+                              (nvalues, test_id))
+            return nvalues
+        except:
+            self.notify_admin_exception("Error storing results of test %s" %
+                                        test_id)
+            return 0
+
+    def check_regressions(self, test_id, wpt_data):
+        """Compare the stored test's results with their baselines, write
+        the comparisons to regressions-<test_id>.json in the
+        regression_report_dir and return them."""
+        try:
+            comparisons = wptregress.check_test(self.connection, test_id,
+                                                wpt_data,
+                                                self.baseline_tests,
+                                                self.baseline_min_tests,
+                                                self.regression_threshold,
+                                                self.regression_min_change)
+            if not comparisons:
+                return comparisons
+            report = {"test_id": test_id,
+                      "jobid": self.job.id,
+                      "label": self.job.label,
+                      "build_revision": self.build_revision,
+                      "build_id": self.build_id,
+                      "url": wpt_data["url"],
+                      "location": wpt_data["location"],
+                      "connectivity": wpt_data["connectivity"],
+                      "threshold": self.regression_threshold,
+                      "min_change": self.regression_min_change,
+                      "comparisons": comparisons}
+            report_path = os.path.join(self.regression_report_dir,
+                                       "regressions-%s.json" % test_id)
+            report_file = open(report_path, "w")
+            try:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+            finally:
+                report_file.close()
+            return comparisons
+        except:
+            self.notify_admin_exception("Error checking regressions of "
+                                        "test %s" % test_id)
+            return []
 
-    def post_to_datazilla(self, test_result):
-        """ take test_results (json) and upload them to datazilla """
+    def get_wpt_data(self, test_result):
+        """Return the tuple of the wpt_data summarizing the compact
+        test_result record from wptresult.extract_result and of the run
+        number of each of its values."""
 
-        # We will attach wpt_data to the datazilla result as a top
-        # level attribute to store out of band data about the test.
+        # wpt_data is attached to the datazilla result as a top level
+        # attribute to store out of band data about the test.
         wpt_data = {
             "url": "",
             "firstView": {},
             "repeatView": {}
         }
         wpt_data["label"] = test_result["data"]["label"]
-        submit_results = False
-        if self.job.datazilla == "on":
-            # Do not short circuit the function but collect
-            # additional data for use in emailing the user
-            # before returning.
-            submit_results = True
-
-        self.logger.debug('Submit results to datazilla: %s' % self.job.datazilla)
         wpt_data["connectivity"] = test_result["data"]["connectivity"]
         wpt_data["location"] = test_result["data"]["location"]
         wpt_data["url"] = test_result["data"]["url"]
         runs = test_result["data"]["runs"]
 
-        # runs[0] is a dummy entry
-        # runs[1]["firstView"]["SpeedIndex"]
-        # runs[1]["repeatView"]["SpeedIndex"]
-        # runs[1]["firstView"]["requests"][0]["headers"]["request"][2]
+        # runs["1"]["firstView"]["SpeedIndex"]
+        # runs["1"]["repeatView"]["SpeedIndex"]
+        # runs["1"]["firstView"]["load_ms"] is the list of the
+        #    load_ms of each request.
+        # test_result["user_agent"]
         #    "User-Agent: Mozilla/5.0 (Windows NT 5.1; rv:26.0) Gecko/20100101 Firefox/26.0 PTST/125"
 
-        wpt_metric_keys = ['TTFB', 'render', 'docTime', 'fullyLoaded',
-                           'SpeedIndex', 'SpeedIndexDT', 'bytesInDoc',
-                           'requestsDoc', 'domContentLoadedEventStart',
-                           'visualComplete']
-        for wpt_key in wpt_metric_keys:
+        # wpt_runs holds the run number of each value in wpt_data.
+        wpt_runs = {"firstView": {}, "repeatView": {}}
+        for wpt_key in WPT_METRIC_KEYS:
             for view in "firstView", "repeatView":
                 wpt_data[view][wpt_key] = []
+                wpt_runs[view][wpt_key] = []
+        load_keys = ['arithmetic_mean', 'geometric_mean', 'quadratic_mean']
+        load_keys.extend(["p%d" % percentile for percentile in PERCENTILES])
         for view in "firstView", "repeatView":
-            wpt_data[view]['load_arithmetic_mean'] = []
-            wpt_data[view]['load_geometric_mean'] = []
-            wpt_data[view]['load_quadratic_mean'] = []
+            for load_key in load_keys:
+                wpt_data[view]['load_%s' % load_key] = []
+                wpt_runs[view]['load_%s' % load_key] = []
 
         # webpagetest changed runs from an array to a dict with keys
         # corresponding to the string value of the index. In addition,
         # it dropped the dummy run at index 0.
         if len(runs) == 0:
-            raise Exception("post_to_datazilla: no runs")
-        os_version = "unknown"
-        os_name = "unknown"
-        platform = "x86"
-        reUserAgent = re.compile('User-Agent: Mozilla/5.0 \(Windows NT ([^;]*);.*')
+            raise Exception("get_wpt_data: no runs")
         for irun in range(1, len(runs)+1, 1):
             run = runs[str(irun)]
             for view in "firstView", "repeatView":
-                if not run[view]:
+                if not run.get(view):
                     continue
-                load_arithmetic_mean = 0.0
-                load_geometric_mean = 1.0
-                load_quadratic_mean = 0.0
-                requests = run[view]["requests"]
-                nrequests = len(requests)
-                for request in requests:
-                    load_ms = abs(float(request["load_ms"]))
-                    load_arithmetic_mean += load_ms
-                    load_geometric_mean *= pow(load_ms, 1.0/nrequests)
-                    load_quadratic_mean += pow(load_ms, 2.0)
-                if nrequests > 0:
-                    load_arithmetic_mean /= nrequests
-                    load_quadratic_mean = pow(load_quadratic_mean/nrequests, 0.5)
-                load_arithmetic_mean = int(round(load_arithmetic_mean))
-                load_geometric_mean = int(round(load_geometric_mean))
-                load_quadratic_mean = int(round(load_quadratic_mean))
-                wpt_data[view]['load_arithmetic_mean'].append(load_arithmetic_mean)
-                wpt_data[view]['load_geometric_mean'].append(load_geometric_mean)
-                wpt_data[view]['load_quadratic_mean'].append(load_quadratic_mean)
-            for wpt_key in wpt_metric_keys:
+                statistics = load_statistics(run[view]["load_ms"])
+                for load_key in load_keys:
+                    wpt_data[view]['load_%s' % load_key].append(
+                        int(round(statistics[load_key])))
+                    wpt_runs[view]['load_%s' % load_key].append(irun)
+            for wpt_key in WPT_METRIC_KEYS:
                 for view in "firstView", "repeatView":
-                    if not run[view]:
+                    if not run.get(view):
                         continue
                     if wpt_key in run[view]:
                         if run[view][wpt_key]:
                             wpt_data[view][wpt_key].append(run[view][wpt_key])
-                    if os_name == "unknown":
-                        try:
-                            requests = run[view]["requests"]
-                            if requests and len(requests) > 0:
-                                request = requests[0]
-                                if request:
-                                    headers = request["headers"]
-                                    if headers:
-                                        request_headers = headers["request"]
-                                        if request_headers:
-                                            for request_header in request_headers:
-                                                if "User-Agent" in request_header:
-                                                    match = re.match(reUserAgent,
-                                                                     request_header)
-                                                    if match:
-                                                        os_name = "WINNT"
-                                                        os_version = match.group(1)
-                                                        break
-                        except KeyError:
-                            pass
+                            wpt_runs[view][wpt_key].append(irun)
+        return (wpt_data, wpt_runs)
+
+    def post_to_datazilla(self, test_result, wpt_data):
+        """Upload wpt_data built from test_result by get_wpt_data to
+        datazilla if the job asked for it and return the datasets."""
+        self.logger.debug('Submit results to datazilla: %s' % self.job.datazilla)
+        if self.job.datazilla != "on":
+            return []
+        os_version = "unknown"
+        os_name = "unknown"
+        platform = "x86"
+        reUserAgent = re.compile('User-Agent: Mozilla/5.0 \(Windows NT ([^;]*);.*')
+        if test_result["user_agent"]:
+            match = re.match(reUserAgent, test_result["user_agent"])
+            if match:
+                os_name = "WINNT"
+                os_version = match.group(1)
 
         machine_name = wpt_data["location"].split(":")[0]
         # limit suite name to 128 characters to match mysql column size
@@ -1068,8 +1737,6 @@ Status:     %(status)s
         datasets = request.datasets()
         for dataset in datasets:
             dataset["wpt_data"] = wpt_data
-            if not submit_results:
-                continue
             response = request.send(dataset)
             # print error responses
             if response.status != 200:
@@ -1088,73 +1755,141 @@ Status:     %(status)s
         return datasets
 
     def check_waiting_jobs(self):
-        """Check waiting jobs that are older than check_minutes or
-        that have not been checked yet to see if builds are
-        available. If they are available, switch them to pending.
+        """Check the builds of waiting jobs to see if they are
+        available. If they are available, switch the jobs to pending.
+
+        Jobs waiting on the same build share a single check and the
+        builds which are due to be checked are checked concurrently.
+        Each build is first checked every check_minutes, doubling after
+        each unsuccessful check up to build_check_max_minutes. Jobs
+        whose build is not available build_deadline_hours after they
+        were submitted are abandoned.
         """
-        check_threshold = ((datetime.datetime.now() -
-                           datetime.timedelta(minutes=self.check_minutes)).
-                           strftime("%Y-%m-%dT%H:%M:%S"))
         try:
             self.cursor.execute(
-                "select * from jobs where status = 'waiting' and "
-                "(timestamp is NULL or timestamp < :check_threshold)",
-                {"check_threshold": check_threshold})
+                "select * from jobs where status = :status order by started",
+                {"status": jobdb.WAITING})
             jobrows = self.cursor.fetchall()
         except sqlite3.OperationalError:
             self.notify_admin_exception("Error checking waiting jobs")
             raise
 
+        now = datetime.datetime.now()
+        build_jobrows_map = {}
         for jobrow in jobrows:
-            (jobid, email, build, label, runs, tcpdump, video, datazilla,
-             prescript, postscript,
-             status, started, timestamp) = jobrow
-            self.set_job(jobid, email, build, label, runs, tcpdump,
-                         video, datazilla, prescript, postscript,
-                         status, started, timestamp)
-
-            self.logger.debug("checking_waiting_jobs: "
-                              "jobid: %s, email: %s, build: %s, label: %s, "
-                              "runs: %s, tcpdump: %s, video: %s, datazilla: %s, "
-                              "prescript: %s, postscript: %s, status: %s, "
-                              "started: %s, timestamp: %s" %
-                              (jobid, email, build, label,
-                               runs, tcpdump, video, datazilla,
-                               prescript, postscript, status,
-                               started, timestamp))
+            build_jobrows_map.setdefault(jobrow[2], []).append(jobrow)
+        for build in self.build_checks.keys():
+            if build not in build_jobrows_map:
+                del self.build_checks[build]
+        due_builds = [build for build in build_jobrows_map
+                      if build not in self.build_checks or
+                      self.build_checks[build]["next"] <= now]
+        self.logger.debug("check_waiting_jobs: checking builds %s" % due_builds)
+
+        self.job = None
+        build_results = self.map_concurrently(self.check_build_result,
+                                              due_builds)
+
+        for ibuild in range(len(due_builds)):
+            build = due_builds[ibuild]
+            (buildurl, exc_info) = build_results[ibuild]
+            build_check = self.build_checks.setdefault(
+                build, {"minutes": self.check_minutes})
+            build_check["next"] = now + datetime.timedelta(
+                minutes=build_check["minutes"])
+            build_check["minutes"] = min(2 * build_check["minutes"],
+                                         self.build_check_max_minutes)
+            for jobrow in build_jobrows_map[build]:
+                self.update_waiting_job(jobrow, buildurl, exc_info)
+
+        self.discard_prefetches()
+        self.discard_listings()
+
+    def check_build_result(self, build):
+        """Return a tuple of the result of check_build and the
+        exception info if check_build raised an exception."""
+        try:
+            return (self.check_build(build), None)
+        except:
+            return (None, sys.exc_info())
+
+    def update_waiting_job(self, jobrow, buildurl, exc_info):
+        """Update the waiting job with the result of checking its build.
+        """
+        (jobid, email, build, label, runs, tcpdump, video, datazilla,
+         prescript, postscript,
+         status, started, timestamp, immediate) = jobrow
+        self.set_job(jobid, email, build, label, runs, tcpdump,
+                     video, datazilla, prescript, postscript,
+                     status, started, timestamp, immediate)
+
+        self.logger.debug("checking_waiting_jobs: "
+                          "jobid: %s, email: %s, build: %s, label: %s, "
+                          "runs: %s, tcpdump: %s, video: %s, datazilla: %s, "
+                          "prescript: %s, postscript: %s, status: %s, "
+                          "started: %s, timestamp: %s" %
+                          (jobid, email, build, label,
+                           runs, tcpdump, video, datazilla,
+                           prescript, postscript, self.job.status,
+                           jobdb.format_time(started),
+                           jobdb.format_time(timestamp)))
+        if exc_info:
             try:
-                buildurl = self.check_build(build)
+                raise exc_info[0], exc_info[1], exc_info[2]
             except:
                 self.notify_admin_exception("Build Error")
                 self.notify_user_exception(email,
                                            "Build Error")
-                self.purge_job(jobid)
-                continue
+            self.purge_job(jobid)
+            return
 
+        if buildurl:
+            status = jobdb.PENDING
+            self.job.status = jobdb.status_name(status)
+            build = buildurl
+            self.prefetch_build(buildurl)
+        else:
+            if started is None:
+                # legacy_epoch leaves started unset for migrated jobs
+                # whose time could not be parsed. The deadline counts
+                # from when the job was last updated instead and that
+                # time is recorded as started below.
+                started = timestamp or int(time.time())
+            deadline = started + self.build_deadline_hours * 3600
+            if time.time() > deadline:
+                self.notify_user_error(email,
+                                       "job abandoned since the build was not "
+                                       "available after %d hours." %
+                                       self.build_deadline_hours)
+                self.purge_job(jobid)
+                return
+        try:
+            timestamp = int(time.time())
+            self.cursor.execute("update jobs set build=:build, "
+                           "status=:status, timestamp=:timestamp, "
+                           "started=coalesce(started, :started) "
+                           "where id=:jobid",
+                           {"jobid": jobid, "build": build,
+                            "status": status, "timestamp": timestamp,
+                            "started": started})
+            self.connection.commit()
+            # The user is only notified once, when the build is found,
+            # rather than after every check of the build.
             if buildurl:
-                self.job.status = status = "pending"
-                build = buildurl
-            try:
-                timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-                self.cursor.execute("update jobs set build=:build, "
-                               "status=:status, timestamp=:timestamp "
-                               "where id=:jobid",
-                               {"jobid": jobid, "build": build,
-                                "status": status, "timestamp": timestamp})
-                self.connection.commit()
                 self.notify_user_info(email,
-                                      "job is pending availability of the build.")
-            except sqlite3.OperationalError:
-                self.notify_admin_exception("Error updating job")
-                self.notify_user_exception(email,
-                                           "job failed")
-                self.purge_job(jobid)
+                                      "build is available, job is pending.")
+        except sqlite3.OperationalError:
+            self.notify_admin_exception("Error updating job")
+            self.notify_user_exception(email,
+                                       "job failed")
+            self.purge_job(jobid)
 
     def check_running_jobs(self):
         """Check the running job if any.
         """
         try:
-            self.cursor.execute("select * from jobs where status = 'running'")
+            self.cursor.execute("select * from jobs where status = :status",
+                                {"status": jobdb.RUNNING})
             jobrows = self.cursor.fetchall()
         except sqlite3.OperationalError:
             self.notify_admin_exception("Error checking running jobs")
@@ -1167,10 +1902,11 @@ Status:     %(status)s
             for jobrow in jobrows:
                 # send email to user then delete job
                 (jobid, email, build, label, runs, tcpdump, video, datazilla,
-                 prescript, postscript, status, started, timestamp) = jobrow
+                 prescript, postscript, status, started, timestamp,
+                 immediate) = jobrow
                 self.set_job(jobid, email, build, label, runs, tcpdump,
                              video, datazilla, prescript, postscript,
-                             status, started, timestamp)
+                             status, started, timestamp, immediate)
                 self.purge_job(jobid)
 
     def check_automatic_jobs(self):
@@ -1195,7 +1931,8 @@ Status:     %(status)s
                                 aj["locations"],
                                 aj["speeds"],
                                 aj["urls"],
-                                aj["scripts"])
+                                aj["scripts"],
+                                aj["immediate"])
                 aj["datetime"] = now
 
 def main():
@@ -1261,16 +1998,24 @@ def main():
     jm = JobMonitor(options)
 
     try:
+        # wptcontroller wakes the monitor when jobs are submitted or
+        # cancelled. Otherwise check every sleep_time seconds.
+        monitor_wakeup = Wakeup(jm.wakeup_socket)
         while True:
             jm.check_automatic_jobs()
             jm.check_waiting_jobs()
             jm.check_running_jobs()
             jm.process_job()
-            time.sleep(jm.sleep_time)
+            jm.notify_admin_summaries()
+            if monitor_wakeup.wait(jm.sleep_time):
+                # wptcontroller may have queued notifications.
+                jm.mail_worker.wake()
     except:
         jm.notify_admin_exception("Error in wptmonitor",
                                   "Terminating wptmonitor due to " +
                                   "unhandled exception: ")
+        jm.notify_admin_summaries(force=True)
+        jm.mail_worker.stop(60)
         exit(2)
 
 if __name__ == "__main__":
@@ -0,0 +1,137 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+# Detection of significant changes in the metrics of a test.
+#
+# Each metric of each view of a test is summarized by the median of its
+# runs and compared with the baseline of its series, the medians of the
+# previous baseline_tests tests of the same url, location and
+# connectivity. The comparison uses the median and the median absolute
+# deviation (MAD) of the baseline, which are not thrown off by the
+# occasional outlier or by an earlier regression. A change is
+# significant when its robust z score exceeds threshold and it changes
+# the metric by at least min_change percent.
+#
+# The baseline of each series is kept in the results store and is
+# updated with each test, so a check only reads one row per series
+# however long the history is. All of the metrics are better when they
+# are lower, so an increase is a regression.
+
+import jobdb
+from wptstats import sorted_percentile
+
+# Scales the MAD to estimate the standard deviation of normally
+# distributed values.
+MAD_SCALE = 1.4826
+
+def median(values):
+    return sorted_percentile(sorted(values), 50)
+
+def compare(value, medians, threshold, min_change, min_tests):
+    """Return a dict describing the comparison of value with the
+    baseline medians. Its result is "regression", "improvement",
+    "unchanged" or "insufficient history" if the baseline has fewer
+    than min_tests tests."""
+    comparison = {"value": value,
+                  "baseline_tests": len(medians),
+                  "baseline_median": None,
+                  "baseline_mad": None,
+                  "change": None,
+                  "z": None,
+                  "result": "insufficient history"}
+    if len(medians) < min_tests:
+        return comparison
+    center = median(medians)
+    mad = median([abs(baseline - center) for baseline in medians])
+    comparison["baseline_median"] = center
+    comparison["baseline_mad"] = mad
+    if center:
+        comparison["change"] = 100.0 * (value - center) / center
+    if mad:
+        comparison["z"] = (value - center) / (MAD_SCALE * mad)
+    # An unvarying baseline has no z score and any change of at least
+    # min_change is significant.
+    significant = (comparison["change"] is not None or
+                   comparison["z"] is not None)
+    if comparison["z"] is not None and abs(comparison["z"]) < threshold:
+        significant = False
+    if (comparison["change"] is not None and
+        abs(comparison["change"]) < min_change):
+        significant = False
+    if not significant:
+        comparison["result"] = "unchanged"
+    elif value > center:
+        comparison["result"] = "regression"
+    else:
+        comparison["result"] = "improvement"
+    return comparison
+
+def check_test(connection, test_id, wpt_data, baseline_tests, min_tests,
+               threshold, min_change):
+    """Compare each metric of each view of the stored test test_id in
+    wpt_data with its baseline, add the test to the baselines and
+    return the list of the comparisons ordered by view and metric.
+    """
+    test = jobdb.get_result_test(connection, test_id)
+    series_map = jobdb.get_series(connection, wpt_data["url"],
+                                  wpt_data["location"],
+                                  wpt_data["connectivity"])
+    baselines = jobdb.get_baselines(connection, series_map.values())
+    comparisons = []
+    updates = []
+    for view in ("firstView", "repeatView"):
+        metrics = wpt_data[view].keys()
+        metrics.sort()
+        for metric in metrics:
+            values = wpt_data[view][metric]
+            series = series_map.get((view, metric))
+            if not values or series is None:
+                continue
+            if series in baselines:
+                (baseline_test, medians) = baselines[series]
+                if baseline_test == test:
+                    # The test was already checked.
+                    continue
+            else:
+                medians = [median(test_values) for test_values in
+                           jobdb.recent_test_values(connection, series, test,
+                                                    baseline_tests)]
+            value = median(values)
+            comparison = compare(value, medians, threshold, min_change,
+                                 min_tests)
+            comparison["view"] = view
+            comparison["metric"] = metric
+            comparisons.append(comparison)
+            updates.append((series, test,
+                            (medians + [value])[-baseline_tests:]))
+    jobdb.set_baselines(connection, updates)
+    return comparisons
+
+def format_changes(comparisons):
+    """Return the text describing the significant changes for the
+    results email."""
+    compared = [comparison for comparison in comparisons
+                if comparison["result"] != "insufficient history"]
+    if not compared:
+        return ""
+    changes = [comparison for comparison in compared
+               if comparison["result"] != "unchanged"]
+    if not changes:
+        return "  No significant changes from the baseline.\n"
+    text = "  Significant changes from the baseline:\n"
+    for comparison in changes:
+        if comparison["change"] is None:
+            change = ""
+        else:
+            change = " %+.1f%%" % comparison["change"]
+        if comparison["z"] is None:
+            z = ""
+        else:
+            z = ", z %.1f" % comparison["z"]
+        text += ("    %s %s: %s %s%s from median %s (MAD %s%s, %d tests)\n" %
+                 (comparison["view"], comparison["metric"],
+                  comparison["value"], comparison["result"].upper(), change,
+                  comparison["baseline_median"], comparison["baseline_mad"],
+                  z, comparison["baseline_tests"]))
+    return text
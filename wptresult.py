@@ -0,0 +1,122 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+# Extract the compact subset of a WebPagetest jsonResult needed by
+# wptmonitor. The result is parsed with ijson as a stream of events
+# read from the response and only the needed values are kept, so
+# neither the response nor the full document is held in memory.
+#
+# The compact record has the form:
+#
+# {
+#     "statusCode": 200,
+#     "user_agent": "User-Agent: Mozilla/5.0 (Windows NT 5.1; rv:26.0) ...",
+#     "data": {
+#         "label": ..., "location": ..., "connectivity": ..., "url": ...,
+#         "runs": {
+#             "1": {
+#                 "firstView": {"SpeedIndex": ..., ..., "load_ms": [...]},
+#                 "repeatView": {...}
+#             },
+#             ...
+#         }
+#     }
+# }
+#
+# Empty views are omitted from their run.
+
+import decimal
+
+import ijson
+
+WPT_METRIC_KEYS = ['TTFB', 'render', 'docTime', 'fullyLoaded',
+                   'SpeedIndex', 'SpeedIndexDT', 'bytesInDoc',
+                   'requestsDoc', 'domContentLoadedEventStart',
+                   'visualComplete']
+
+VIEWS = ("firstView", "repeatView")
+
+DATA_KEYS = ("label", "location", "connectivity", "url")
+
+def new_record():
+    return {"statusCode": None,
+            "user_agent": None,
+            "data": {"label": "",
+                     "location": "",
+                     "connectivity": "",
+                     "url": "",
+                     "runs": {}}}
+
+def number(value):
+    """Convert the Decimal values returned by some ijson backends to
+    the int or float json would have returned."""
+    if isinstance(value, decimal.Decimal):
+        if value == value.to_integral_value():
+            return int(value)
+        return float(value)
+    return value
+
+class TeeReader(object):
+    """A file like object which reads from fileobj and writes what it
+    reads to copy."""
+    def __init__(self, fileobj, copy):
+        self.fileobj = fileobj
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.copy.write(data)
+        return data
+
+def extract_result(fileobj):
+    """Return the compact record for the jsonResult read from fileobj.
+    Raises ValueError if it is not valid JSON.
+    """
+    try:
+        return extract_events(ijson.parse(fileobj))
+    except ijson.JSONError, e:
+        raise ValueError("Invalid jsonResult: %s" % e)
+
+def extract_events(events):
+    """Build the compact record from an iterator of ijson (prefix, event,
+    value) tuples without building the full document.
+    """
+    record = new_record()
+    data = record["data"]
+    runs = data["runs"]
+    for prefix, event, value in events:
+        if prefix == "statusCode" and event == "number":
+            record["statusCode"] = number(value)
+            continue
+        if not prefix.startswith("data."):
+            continue
+        path = prefix.split(".")
+        if len(path) == 2:
+            if path[1] in DATA_KEYS and event == "string":
+                data[path[1]] = value
+            elif path[1] == "runs" and event == "map_key":
+                runs.setdefault(value, {})
+            continue
+        if path[1] != "runs" or len(path) < 4 or path[3] not in VIEWS:
+            continue
+        # path is data.runs.<run>.<view>...
+        if len(path) == 4:
+            if event == "map_key":
+                run = runs.setdefault(path[2], {})
+                run.setdefault(path[3], {"load_ms": []})
+            continue
+        view = runs.get(path[2], {}).get(path[3])
+        if view is None:
+            continue
+        if len(path) == 5:
+            if path[4] in WPT_METRIC_KEYS and event in ("number", "string"):
+                view[path[4]] = number(value)
+        elif len(path) == 7 and path[4:] == ["requests", "item", "load_ms"]:
+            if event in ("number", "string"):
+                view["load_ms"].append(number(value))
+        elif (record["user_agent"] is None and event == "string" and
+              path[4:] == ["requests", "item", "headers", "request", "item"] and
+              "User-Agent" in value):
+            record["user_agent"] = value
+    return record
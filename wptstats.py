@@ -0,0 +1,140 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+# Summary statistics of the request load times of a WebPagetest run.
+# numpy is used when available, otherwise the statistics are computed
+# with math.fsum so that large runs do not lose precision.
+
+import bisect
+import math
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PERCENTILES = (50, 90, 99)
+
+def load_statistics(load_ms_list):
+    """Return a dict containing the arithmetic, geometric and
+    quadratic means and the PERCENTILES of the absolute values of
+    load_ms_list.
+
+    The geometric mean is computed from the mean of the logarithms of
+    the positive load times. Requests with a load time of 0 do not
+    contribute to it rather than forcing it to 0. All of the statistics
+    are 0 if there are no load times.
+    """
+    if numpy:
+        return numpy_load_statistics(load_ms_list)
+    return python_load_statistics(load_ms_list)
+
+def empty_statistics():
+    statistics = {"arithmetic_mean": 0.0,
+                  "geometric_mean": 0.0,
+                  "quadratic_mean": 0.0}
+    for percentile in PERCENTILES:
+        statistics["p%d" % percentile] = 0.0
+    return statistics
+
+def numpy_load_statistics(load_ms_list):
+    values = numpy.abs(numpy.asarray(load_ms_list, dtype=numpy.float64))
+    if values.size == 0:
+        return empty_statistics()
+    positive = values[values > 0]
+    statistics = {
+        "arithmetic_mean": float(values.mean()),
+        "geometric_mean": (float(numpy.exp(numpy.log(positive).mean()))
+                           if positive.size else 0.0),
+        "quadratic_mean": float(numpy.sqrt(numpy.dot(values, values) /
+                                           values.size)),
+    }
+    for percentile, value in zip(PERCENTILES,
+                                 numpy.percentile(values, PERCENTILES)):
+        statistics["p%d" % percentile] = float(value)
+    return statistics
+
+def python_load_statistics(load_ms_list):
+    values = sorted(map(abs, map(float, load_ms_list)))
+    nvalues = len(values)
+    if nvalues == 0:
+        return empty_statistics()
+    positive = values[bisect.bisect_right(values, 0.0):]
+    statistics = {
+        "arithmetic_mean": math.fsum(values) / nvalues,
+        "geometric_mean": (math.exp(math.fsum(map(math.log, positive)) /
+                                    len(positive))
+                           if positive else 0.0),
+        "quadratic_mean": math.sqrt(math.fsum(map(operator.mul, values,
+                                                  values)) /
+                                    nvalues),
+    }
+    for percentile in PERCENTILES:
+        statistics["p%d" % percentile] = sorted_percentile(values, percentile)
+    return statistics
+
+def sorted_percentile(values, percentile):
+    """Return the percentile of the sorted list values using linear
+    interpolation between the closest ranks as numpy.percentile does.
+    """
+    rank = (len(values) - 1) * percentile / 100.0
+    lower = int(math.floor(rank))
+    upper = int(math.ceil(rank))
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+if __name__ == "__main__":
+    # Micro-benchmark comparing the per-request loop formerly used in
+    # wptmonitor.post_to_datazilla with load_statistics for synthetic
+    # 5,000 request runs.
+    import random
+    import timeit
+
+    def loop_load_statistics(load_ms_list):
+        load_arithmetic_mean = 0.0
+        load_geometric_mean = 1.0
+        load_quadratic_mean = 0.0
+        nrequests = len(load_ms_list)
+        for load_ms in load_ms_list:
+            load_ms = abs(float(load_ms))
+            load_arithmetic_mean += load_ms
+            load_geometric_mean *= pow(load_ms, 1.0/nrequests)
+            load_quadratic_mean += pow(load_ms, 2.0)
+        if nrequests > 0:
+            load_arithmetic_mean /= nrequests
+            load_quadratic_mean = pow(load_quadratic_mean/nrequests, 0.5)
+        return (load_arithmetic_mean, load_geometric_mean, load_quadratic_mean)
+
+    random.seed(0)
+    nruns = 20
+    runs = [[int(random.lognormvariate(5, 1.5)) for i in range(5000)]
+            for irun in range(nruns)]
+    runs[0][0] = 0
+    print "numpy: %s" % ("yes" if numpy else "no")
+    print "loop geometric mean with a 0 load time: %.1f" % (
+        loop_load_statistics(runs[0])[1])
+    print "load_statistics geometric mean with a 0 load time: %.1f" % (
+        load_statistics(runs[0])["geometric_mean"])
+    print "loop geometric mean of the positive load times: %.1f" % (
+        loop_load_statistics([load_ms for load_ms in runs[0] if load_ms])[1])
+    # Apart from the geometric mean of runs with 0 load times, the
+    # statistics match the loop's.
+    differences = []
+    for run in runs:
+        statistics = load_statistics(run)
+        loop_values = loop_load_statistics(run)
+        loop_geometric_mean = loop_load_statistics(
+            [load_ms for load_ms in run if load_ms])[1]
+        for key, value in (("arithmetic_mean", loop_values[0]),
+                           ("geometric_mean", loop_geometric_mean),
+                           ("quadratic_mean", loop_values[2])):
+            differences.append(abs(statistics[key] - value) / value)
+    print "largest relative difference from the loop's means: %.2g" % max(
+        differences)
+    for name, function in (("loop", loop_load_statistics),
+                           ("python", python_load_statistics),
+                           ("load_statistics", load_statistics)):
+        seconds = min(timeit.repeat(lambda: [function(run) for run in runs],
+                                    repeat=3, number=5)) / (5 * nruns)
+        print "%-16s %8.3f ms per 5,000 request run" % (name, seconds * 1000)
@@ -0,0 +1,58 @@
+# This Source Code is subject to the terms of the Mozilla Public License
+# version 2.0 (the "License"). You can obtain a copy of the License at
+# http://mozilla.org/MPL/2.0/.
+
+# Minimal precompiled templates for wptcontroller's pages.
+#
+# A template is text containing %(name)s fields and %% escapes as used
+# with the % operator. It is split once into its literal text and
+# fields so that rendering only yields the literal byte strings and the
+# field values. A field's value may be an iterable of strings such as a
+# generator, which lets a page be streamed while it is produced.
+
+import re
+
+re_field = re.compile(r"%(?:\((\w+)\)s|%)")
+
+def to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+class Template(object):
+    def __init__(self, text):
+        # list of (literal, name) tuples where the last name is None.
+        self.parts = []
+        literal = []
+        position = 0
+        for match in re_field.finditer(text):
+            literal.append(text[position:match.start()])
+            position = match.end()
+            if match.group(1) is None:
+                literal.append("%")
+            else:
+                self.parts.append((to_bytes("".join(literal)),
+                                   match.group(1)))
+                literal = []
+        literal.append(text[position:])
+        self.parts.append((to_bytes("".join(literal)), None))
+
+    def generate(self, values):
+        """Yield the chunks of the template with its fields replaced by
+        the corresponding entries of the dict values."""
+        for literal, name in self.parts:
+            if literal:
+                yield literal
+            if name is None:
+                continue
+            value = values[name]
+            if isinstance(value, basestring) or not hasattr(value, "__iter__"):
+                yield to_bytes(value)
+            else:
+                for chunk in value:
+                    yield to_bytes(chunk)
+
+    def render(self, values):
+        """Return the template with its fields replaced by the
+        corresponding entries of the dict values."""
+        return "".join(self.generate(values))